@@ -0,0 +1,56 @@
+"""
+    原子写入文件与进程间的文件锁
+
+    --> 写入：先写入同一目录下的临时文件，写入完成后以 os.replace 替换目标文件
+
+    --> 读取：正在运行的进程（包括以 mmap 读取的）仍读取原有的文件，不会读到写了一半的文件
+
+    --> 出错：写入中断时删除临时文件，原有的文件不变
+
+    --> 加锁：以 fcntl.flock 对锁文件加排他锁，多个进程（如同时执行的语料库维护命令）依次修改同一组文件
+
+"""
+
+from contextlib import contextmanager
+import tempfile
+import fcntl
+import os
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    返回临时文件的路径，由调用者写入（如 SQLite），with 块正常结束后替换 path
+
+    临时文件名由 mkstemp 生成，多个进程同时写入同一文件时互不影响；替换后保留原有文件的权限
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory or '.')
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def atomic_write(path, mode='w', encoding='utf-8'):
+    """以 mode 打开临时文件，with 块正常结束后替换 path；二进制模式时忽略 encoding"""
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode, encoding=None if 'b' in mode else encoding) as f:
+            yield f
+
+
+@contextmanager
+def file_lock(path):
+    """对锁文件 path 加排他锁，其他进程在 with 块结束前等待；同一进程内不可重入"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,177 @@
+"""
+    关键词自动机（Aho-Corasick）
+
+    --> 构建：将所有关键词（领域关键词、实体名称等）插入字典树，并计算失败指针
+
+    --> 匹配：对问句做一次线性扫描，找出所有关键词的命中位置及其标签
+
+    --> 选择：按最长匹配、从左到右的规则选出互不重叠的命中
+
+    构建完成后，字典树以扁平的 array 保存，不含大量小对象
+
+"""
+
+from collections import namedtuple, deque
+from bisect import bisect_left
+from array import array
+
+# 一次命中：[start, end) 为在问句中的位置，labels 为该词所属的标签名称
+Hit = namedtuple('Hit', ['start', 'end', 'word', 'labels'])
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick 自动机
+
+        每个关键词可以带有多个标签（例如同一名称既是疾病也是症状），
+        标签以位掩码保存，因此标签数量不超过 64 个
+    """
+
+    def __init__(self, labels):
+        self.labels = list(labels)
+        if len(self.labels) > 64:
+            raise ValueError(f'At most 64 labels are supported, but got: {len(self.labels)}')
+        self.label_bits = {label: 1 << i for i, label in enumerate(self.labels)}
+        self._trie = [dict()]
+        self._masks = [0]
+        self.built = False
+
+    def add(self, word, label):
+        """添加关键词，需在 build 之前调用"""
+        if self.built:
+            raise RuntimeError('Automaton is already built.')
+        if not word:
+            return
+        node = 0
+        for ch in word:
+            nxt = self._trie[node].get(ch)
+            if nxt is None:
+                nxt = len(self._trie)
+                self._trie[node][ch] = nxt
+                self._trie.append(dict())
+                self._masks.append(0)
+            node = nxt
+        self._masks[node] |= self.label_bits[label]
+
+    def mask(self, labels):
+        """将标签名称转换为位掩码"""
+        mask = 0
+        for label in labels:
+            mask |= self.label_bits[label]
+        return mask
+
+    def build(self):
+        """计算失败指针与输出链接，并将字典树压缩为扁平数组"""
+        n = len(self._trie)
+        depth = array('I', [0]) * n
+        fail = array('I', [0]) * n
+        out_link = array('I', [0]) * n
+
+        # 按广度优先顺序计算失败指针：fail 指向当前结点的最长真后缀所在结点
+        queue = deque()
+        for nxt in self._trie[0].values():
+            depth[nxt] = 1
+            queue.append(nxt)
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._trie[node].items():
+                depth[nxt] = depth[node] + 1
+                f = fail[node]
+                while f and ch not in self._trie[f]:
+                    f = fail[f]
+                f = self._trie[f].get(ch, 0)
+                fail[nxt] = f if f != nxt else 0
+                # out_link 指向失败链上最近的、以关键词结尾的结点
+                out_link[nxt] = fail[nxt] if self._masks[fail[nxt]] else out_link[fail[nxt]]
+                queue.append(nxt)
+
+        # 各结点的子结点按字符排序后连续存放，转移时二分查找
+        child_start = array('I', [0]) * (n + 1)
+        child_chars = array('I')
+        child_next = array('I')
+        for node, children in enumerate(self._trie):
+            child_start[node] = len(child_chars)
+            for ch in sorted(children):
+                child_chars.append(ord(ch))
+                child_next.append(children[ch])
+        child_start[n] = len(child_chars)
+
+        self.depth = depth
+        self.fail = fail
+        self.out_link = out_link
+        self.masks = array('Q', self._masks)
+        self.child_start = child_start
+        self.child_chars = child_chars
+        self.child_next = child_next
+        self._trie = None
+        self._masks = None
+        self.built = True
+        return self
+
+    def __len__(self):
+        return len(self.fail) if self.built else len(self._trie)
+
+    def _goto(self, node, code):
+        lo, hi = self.child_start[node], self.child_start[node + 1]
+        i = bisect_left(self.child_chars, code, lo, hi)
+        if i < hi and self.child_chars[i] == code:
+            return self.child_next[i]
+        return -1
+
+    def scan(self, text):
+        """线性扫描问句，依次产生 (start, end, mask)"""
+        masks, depth, fail, out_link = self.masks, self.depth, self.fail, self.out_link
+        node = 0
+        for pos, ch in enumerate(text):
+            code = ord(ch)
+            while True:
+                nxt = self._goto(node, code)
+                if nxt >= 0:
+                    node = nxt
+                    break
+                if node == 0:
+                    break
+                node = fail[node]
+
+            end = pos + 1
+            out = node if masks[node] else out_link[node]
+            while out:
+                yield end - depth[out], end, masks[out]
+                out = out_link[out]
+
+    def _to_hit(self, text, start, end, mask):
+        labels = [label for label in self.labels if mask & self.label_bits[label]]
+        return Hit(start, end, text[start:end], labels)
+
+    def find_all(self, text, labels=None):
+        """返回所有命中（允许重叠），labels 限定只返回这些标签"""
+        select = self.mask(labels) if labels is not None else -1
+        hits = list()
+        for start, end, mask in self.scan(text):
+            mask &= select
+            if mask:
+                hits.append(self._to_hit(text, start, end, mask))
+        hits.sort(key=lambda h: (h.start, h.end))
+        return hits
+
+    def find_longest(self, text, labels=None):
+        """
+        返回互不重叠的命中：从左到右，重叠时保留最长的一个
+
+        同一位置的命中保留其全部标签
+        """
+        select = self.mask(labels) if labels is not None else -1
+        spans = list()
+        for start, end, mask in self.scan(text):
+            mask &= select
+            if mask:
+                spans.append((start, -end, mask))
+        spans.sort()
+
+        hits = list()
+        last_end = 0
+        for start, neg_end, mask in spans:
+            if start >= last_end:
+                hits.append(self._to_hit(text, start, -neg_end, mask))
+                last_end = -neg_end
+        return hits
@@ -0,0 +1,149 @@
+"""
+    缓存
+
+    --> AnswerCache：持久化的答案缓存（SQLite），进程重启后仍然有效
+
+    --> ResultCache：进程内的 LRU 缓存，保存各层的匹配结果
+
+"""
+
+from collections import OrderedDict
+import threading
+import sqlite3
+import time
+import os
+import re
+
+from config.path_config import *
+
+
+class AnswerCache:
+    """
+    以规范化的问句为键的答案缓存
+
+        记录超过 ttl 秒后过期；没有答案的结果同样缓存，但只保存 negative_ttl 秒；
+        记录数超过 max_size 时，按最近访问时间淘汰（LRU）
+    """
+
+    # get 未命中时的返回值，与缓存的"没有答案"（None）区分
+    MISS = object()
+
+    def __init__(self, path=INTERNET_CACHE_PATH, ttl=7 * 24 * 3600, negative_ttl=600, max_size=10000):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        """数据库连接，fork 之后的子进程重新打开"""
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS answers '
+                         '(key TEXT PRIMARY KEY, answer TEXT, expires REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def normalize(question):
+        """规范化问句：去除首尾空白与句末标点，合并连续空白，英文转为小写"""
+        question = re.sub(r'\s+', ' ', question.strip()).lower()
+        return re.sub(r'[?？!！。.~～]+$', '', question)
+
+    def get(self, key):
+        """返回缓存的答案（可能为 None，表示没有答案），未命中或已过期时返回 MISS"""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute('SELECT answer, expires FROM answers WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return self.MISS
+            if row[1] < now:
+                self.conn.execute('DELETE FROM answers WHERE key = ?', (key,))
+                return self.MISS
+            self.conn.execute('UPDATE answers SET accessed = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def set(self, key, answer):
+        """缓存答案，answer 为 None 表示没有答案"""
+        now = time.time()
+        expires = now + (self.ttl if answer is not None else self.negative_ttl)
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)', (key, answer, expires, now))
+            self.evict(now)
+
+    def evict(self, now):
+        """删除过期记录，记录数仍超过 max_size 时删除最久未访问的记录"""
+        self.conn.execute('DELETE FROM answers WHERE expires < ?', (now,))
+        size = self.conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+        if size > self.max_size:
+            self.conn.execute('DELETE FROM answers WHERE key IN '
+                              '(SELECT key FROM answers ORDER BY accessed LIMIT ?)', (size - self.max_size,))
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM answers')
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ResultCache:
+    """
+    以问句为键、保存匹配结果（而不是最终答案）的 LRU 缓存
+
+        命中后仍由对应的层生成答案，因此随机选择的答案依然随机；
+        模板、语料库或知识图谱重新构建后需调用 clear
+    """
+
+    MISS = AnswerCache.MISS
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """返回缓存的匹配结果，未命中时返回 MISS"""
+        with self._lock:
+            value = self._items.get(key, self.MISS)
+            if value is self.MISS:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        """命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 4) if total else 0.0}
+
+    def __len__(self):
+        return len(self._items)
@@ -7,51 +7,134 @@
 
 """
 
+from zlib import crc32
+import threading
+import logging
+import queue
 import time
 
-from itchat.content import TEXT
-import itchat
+from filter import LayerFilter, Session
+from chatlog import ChatLogSink
+from metrics import MetricsWriter
 
-from filter import LayerFilter
+
+class MessageDispatcher:
+    """
+    消息分发器：接收消息的线程只把任务放入队列，由若干工作线程执行
+
+        同一会话的任务总是交给同一个工作线程，因此回复顺序与提问顺序一致；
+        队列已满时最多等待 put_timeout 秒（背压），仍然放不进去则丢弃该任务（降载）
+    """
+
+    def __init__(self, workers=4, queue_size=64, put_timeout=0.5):
+        self.logger = logging.getLogger()
+        self.put_timeout = put_timeout
+        self.dropped = 0
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.threads = list()
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=(q,), name=f'dispatcher-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self, q):
+        """工作线程：依次执行队列中的任务，任务出错不影响后续任务"""
+        while True:
+            task = q.get()
+            if task is None:
+                break
+            try:
+                task()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def submit(self, conversation, task):
+        """提交任务，放入队列失败（过载）时返回 False"""
+        q = self.queues[crc32(conversation.encode('utf-8')) % len(self.queues)]
+        try:
+            q.put(task, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self.logger.warning(f'Dispatcher is overloaded, message dropped: {conversation}')
+            return False
+
+    def stop(self):
+        """处理完已提交的任务后结束工作线程"""
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
 
 
 class WXChatBot:
     """机器人类，拥有联网（微信）以及本地两种聊天模式"""
 
-    def __init__(self):
-        self.layer_filter = LayerFilter()
-        self.white_list = []
+    # 过载时对被丢弃的消息的回复，为 None 时不回复
+    BUSY_ANSWER = '消息太多，我有点忙不过来，请稍后再问~'
 
-    @classmethod
-    def to_log(cls, question, answer):
-        with open('config/chat_log.txt', 'a', encoding='utf-8') as f:
-            log_content = f'Q:{question}---A:{answer} \n'
-            print(log_content)
-            f.write(log_content)
+    def __init__(self, workers=4, queue_size=64):
+        self.layer_filter = LayerFilter(warm_up=True)
+        self.chat_log = ChatLogSink()
+        self.metrics_writer = MetricsWriter(self.layer_filter.metrics_text)
+        self.sessions = dict()
+        self.white_list = []
+        self.workers = workers
+        self.queue_size = queue_size
+
+    def to_log(self, user, question, reply):
+        """记录问答，由后台线程写入文件，不阻塞回复"""
+        self.chat_log.log(user, question, reply.text, reply.layer, reply.latency)
+
+    def get_session(self, conversation):
+        """每个好友、群聊各自的会话设置（如联网模式）"""
+        return self.sessions.setdefault(conversation, Session())
+
+    def group_answer(self, msg):
+        """回复群聊中 @ 机器人的消息"""
+        question = msg.text
+        print(question)
+        reply = self.layer_filter.get_reply(question, self.get_session(msg.user.UserName))
+        self.to_log(msg.ActualUserName, question, reply)
+        answer = '@' + msg.ActualNickName + ' ' + reply.text
+        msg.user.send(answer)
+
+    def single_answer(self, msg):
+        """回复好友消息"""
+        question = msg.text
+        reply = self.layer_filter.get_reply(question, self.get_session(msg.user.UserName))
+        self.to_log(msg.user.UserName, question, reply)
+        msg.user.send(reply.text)
+
+    def dispatch(self, dispatcher, msg, task):
+        """将回复任务交给分发器，过载时直接回复繁忙提示"""
+        if not dispatcher.submit(msg.user.UserName, task) and self.BUSY_ANSWER:
+            msg.user.send(self.BUSY_ANSWER)
 
     def inter_start(self):
-        """联网聊天模式"""
+        """联网聊天模式，消息的接收与回复分别在不同线程中进行，慢的回复不会阻塞其他会话"""
+        from itchat.content import TEXT
+        import itchat
+
+        dispatcher = MessageDispatcher(self.workers, self.queue_size)
 
         @itchat.msg_register(TEXT, isGroupChat=True)
         def group_reply(msg):
             is_at = msg.isAt
             if is_at:
-                question = msg.text
-                print(question)
-                answer = self.layer_filter.get_answer(question)
-                self.to_log(question, answer)
-                answer = '@' + msg.ActualNickName + ' ' + answer
-                msg.user.send(answer)
+                self.dispatch(dispatcher, msg, lambda: self.group_answer(msg))
 
         @itchat.msg_register(TEXT, isFriendChat=True, isGroupChat=False, isMpChat=False)
         def single_reply(msg):
-            question = msg.text
-            answer = self.layer_filter.get_answer(question)
-            self.to_log(question, answer)
-            msg.user.send(answer)
+            self.dispatch(dispatcher, msg, lambda: self.single_answer(msg))
 
         itchat.auto_login(True)
-        itchat.run()
+        try:
+            itchat.run()
+        finally:
+            dispatcher.stop()
+            self.chat_log.close()
+            self.metrics_writer.stop()
 
     def local_start(self):
         """本地聊天模式"""
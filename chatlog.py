@@ -0,0 +1,130 @@
+"""
+    聊天记录
+
+    --> 记录：每条问答为一行 json（时间、用户、回答的层、耗时、问题、答案），便于追加与逐行解析
+
+    --> 缓冲：回复线程只把记录放入队列，由后台线程批量写入，队列已满时丢弃记录，不阻塞回复
+
+    --> 刷新：缓冲的记录达到 flush_size 条或距上次写入超过 flush_interval 秒时写入文件
+
+    --> 切分：文件超过 max_bytes 或日期变化时，将当前文件改名归档，只保留最近 backup_count 个
+
+"""
+
+from datetime import datetime, date
+import threading
+import logging
+import atexit
+import queue
+import json
+import glob
+import time
+import os
+
+from config.path_config import *
+
+
+class ChatLogSink:
+    """后台写入的聊天记录文件"""
+
+    def __init__(self, path=CHAT_LOG_PATH, flush_size=100, flush_interval=1.0,
+                 max_bytes=16 * 1024 * 1024, rotate_daily=True, backup_count=7, queue_size=10000):
+        self.logger = logging.getLogger()
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self._file_date = None
+        self._thread = threading.Thread(target=self.work, name='chat-log', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, user, question, answer, layer=None, latency=None):
+        """记录一条问答，latency 单位为秒"""
+        record = {'ts': datetime.now().isoformat(timespec='milliseconds'),
+                  'user': user,
+                  'layer': layer,
+                  'latency_ms': round(latency * 1000, 3) if latency is not None else None,
+                  'question': question,
+                  'answer': answer}
+        self.write(record)
+
+    def write(self, record):
+        """放入队列，队列已满时丢弃，返回是否放入"""
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def work(self):
+        """后台线程：收集记录，按数量或时间批量写入"""
+        batch = list()
+        last_flush = time.monotonic()
+        stopped = False
+        while not stopped:
+            timeout = self.flush_interval - (time.monotonic() - last_flush)
+            try:
+                record = self._queue.get(timeout=max(timeout, 0))
+                if record is None:
+                    stopped = True
+                else:
+                    batch.append(record)
+            except queue.Empty:
+                pass
+
+            if stopped or len(batch) >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval:
+                if batch:
+                    self.flush(batch)
+                    batch = list()
+                last_flush = time.monotonic()
+
+    def flush(self, batch):
+        """写入一批记录，出错时丢弃该批记录"""
+        try:
+            self.rotate()
+            self._file.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in batch))
+            self._file.flush()
+        except Exception as e:
+            self.logger.warning(f'Chat log write failed, {len(batch)} records dropped: {e}')
+
+    def open(self):
+        """以追加方式打开日志文件，已有内容时按文件的修改日期确定其日期"""
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._file.tell():
+            self._file_date = date.fromtimestamp(os.path.getmtime(self.path))
+        else:
+            self._file_date = date.today()
+
+    def rotate(self):
+        """文件超过大小或日期变化时，归档当前文件并重新打开"""
+        if self._file is None:
+            self.open()
+        expired = self.rotate_daily and self._file_date != date.today()
+        if expired or self._file.tell() >= self.max_bytes:
+            self._file.close()
+            os.replace(self.path, f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+            self.remove_backups()
+            self.open()
+
+    def remove_backups(self):
+        """只保留最近的 backup_count 个归档"""
+        backups = sorted(glob.glob(glob.escape(self.path) + '.*'))
+        for backup in backups[:max(len(backups) - self.backup_count, 0)]:
+            os.remove(backup)
+
+    def close(self):
+        """写入队列中剩余的记录后结束后台线程"""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
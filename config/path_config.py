@@ -13,7 +13,11 @@ VOCABULARY_PATH = BASE_CONFIG + 'vocab_from_q.json'
 
 SPECIAL_WORDS_PATH = BASE_CONFIG + 'special_words.txt'
 
-INVERSE_INDEX_PATH = BASE_CONFIG + 'inverse_index.json'
+CORPUS_INDEX_PATH = BASE_CONFIG + 'corpus_index.npz'
+
+QUESTION_IDS_PATH = BASE_CONFIG + 'question_ids.npz'
+
+CORPUS_LOCK_PATH = BASE_CONFIG + 'corpus.lock'
 
 SELF_TEMP_FILE = BASE_CONFIG + 'robot_template.xml'
 
@@ -21,6 +25,18 @@ DEFAULT_PATH = BASE_CONFIG + 'default_answer.xml'
 
 WORD2VEC_MODEL_PATH = BASE_CONFIG + 'word2vec.model'
 
+SENTENCE_VECTOR_PATH = BASE_CONFIG + 'sentence_vectors.npz'
+
+BUILD_MANIFEST_PATH = BASE_CONFIG + 'build_manifest.json'
+
+TOKENIZER_DICT_PATH = BASE_CONFIG + 'tokenizer_dict.cache'
+
+INTERNET_CACHE_PATH = BASE_CONFIG + 'internet_cache.db'
+
+CHAT_LOG_PATH = BASE_CONFIG + 'chat_log.jsonl'
+
+METRICS_PATH = BASE_CONFIG + 'metrics.prom'
+
 # 知识图谱的基础存储路径
 BASE_INDEX_PATH = 'kg_index/'
 
@@ -34,3 +50,7 @@ MEDICAL_ORIGIN_INDEX_PATH = MEDICAL_BASE_INDEX_PATH + 'origin_index.json'
 MEDICAL_ENTITY_BASE_PATH = MEDICAL_BASE_INDEX_PATH + 'entity_node/'
 
 MEDICAL_RELATION_INDEX_PATH = MEDICAL_BASE_INDEX_PATH + 'relation_edge/'
+
+MEDICAL_GRAPH_PATH = MEDICAL_BASE_INDEX_PATH + 'graph.bin'
+
+MEDICAL_RECORDS_PATH = MEDICAL_BASE_INDEX_PATH + 'records.db'
@@ -19,23 +19,466 @@
 
 """
 
+from collections import Counter, deque
+from array import array
+import multiprocessing
 import urllib.request
 import urllib.parse
 import hashlib
 import logging
 import base64
+import itertools
+import threading
 import json
 import time
+import os
 import re
 
-from gensim.models import Word2Vec
-import jieba
+import numpy as np
 
 from config.path_config import *
+from atomic_file import atomic_write, file_lock
+from tokenizer import get_segmenter
+
+
+class Query:
+    """
+    单个问句的分析结果，由 LayerFilter 构建一次后交给各层共享
+
+        text：原始问句
+        normal：规范化后的问句（去除首尾空白）
+        words：分词结果
+        word_ids：各词在问句字典（vocab_from_q.json）中的序号，未登录词忽略
+        entities：医疗实体的命中结果，{实体类型: [实体名称]}
+
+    未给出的分析结果在首次使用时计算
+    """
+
+    def __init__(self, text, words=None, word_ids=None, entities=None):
+        self.text = text
+        self.normal = text.strip()
+        self._words = words
+        self.word_ids = word_ids
+        self.entities = entities
+
+    @property
+    def words(self):
+        if self._words is None:
+            self._words = get_segmenter().lcut(self.normal)
+        return self._words
+
+    @staticmethod
+    def segment(queries):
+        """对尚未分词的多个问句一次性分词，结果与逐个分词相同"""
+        pending = [q for q in queries if q._words is None]
+        if pending:
+            for q, words in zip(pending, get_segmenter().lcut_batch([q.normal for q in pending])):
+                q._words = words
+
+    def __repr__(self):
+        return f'Query({self.text!r})'
+
+
+class CorpusIndex:
+    """
+    语料库问句的 TF-IDF 矩阵
+
+        矩阵以词序号为行、问句序号为列，按行压缩存储（即带权重的倒排索引），
+        问句向量均已归一化，查询时一次稀疏矩阵与向量的乘法即得到与所有问句的余弦相似度。
+        同时保存各问句对应的答案文本，加载时无需重新分词
+    """
+
+    # 未登录词的权重相对于 idf 中位数的比例：为 1 时“我是好人”匹配不上“我是”，
+    # 太小时“我想买一台电脑”只凭“我想”匹配上“我想你”；按 chat_log.txt 的回放选取
+    UNKNOWN_WEIGHT = 0.5
+
+    def __init__(self, offsets, docs, weights, idf, answer_offsets, answer_data):
+        self.offsets = offsets
+        self.docs = docs
+        self.weights = weights
+        self.idf = idf
+        self.answer_offsets = answer_offsets
+        self.answer_data = answer_data
+        self.size = len(answer_offsets) - 1
+
+        # 未登录词（如人名、昵称）计入问句向量的模，idf 取所有词 idf 的中位数乘以 UNKNOWN_WEIGHT
+        known = self.idf[self.idf > 0]
+        self.unknown_idf = self.UNKNOWN_WEIGHT * float(np.median(known)) if len(known) else 1.0
+
+    @classmethod
+    def build(cls, q_list, a_list, vocab):
+        """根据分好词的问句、答案以及字典构建矩阵"""
+        n = len(q_list)
+        dim = max(vocab.values()) + 1
+
+        # 统计每个问句中各词的词频
+        term_list, doc_list, tf_list = list(), list(), list()
+        for i, q in enumerate(q_list):
+            for w, tf in Counter(q).items():
+                term_list.append(vocab[w])
+                doc_list.append(i)
+                tf_list.append(tf)
+        terms = np.array(term_list, dtype=np.int64)
+        docs = np.array(doc_list, dtype=np.uint32)
+        tfs = np.array(tf_list, dtype=np.float32)
+
+        answers = [''.join(a).encode('utf-8') for a in a_list]
+        answer_offsets = np.zeros(len(answers) + 1, dtype=np.uint64)
+        np.cumsum([len(a) for a in answers], out=answer_offsets[1:])
+        answer_data = np.frombuffer(b''.join(answers), dtype=np.uint8)
+
+        return cls.from_counts(terms, docs, tfs, n, dim, answer_offsets, answer_data)
+
+    @classmethod
+    def from_counts(cls, terms, docs, tfs, n, dim, answer_offsets, answer_data):
+        """根据 (词序号, 问句序号, 词频) 三元组构建矩阵"""
+        terms = terms.astype(np.int64, copy=False)
+        docs = docs.astype(np.uint32, copy=False)
+        tfs = tfs.astype(np.float32, copy=False)
+
+        # 平滑的 idf：log((1 + N) / (1 + df)) + 1
+        df = np.bincount(terms, minlength=dim)
+        idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+
+        # 计算 tf-idf 权重，并对每个问句向量归一化
+        weights = tfs * idf[terms]
+        norms = np.sqrt(np.bincount(docs, weights=weights ** 2, minlength=n))
+        weights /= np.maximum(norms[docs], 1e-12).astype(np.float32)
+
+        # 按词序号排序，生成行压缩格式
+        order = np.lexsort((docs, terms))
+        offsets = np.zeros(dim + 1, dtype=np.uint32)
+        np.cumsum(df, out=offsets[1:])
+
+        return cls(offsets, docs[order], weights[order], idf, answer_offsets, answer_data)
+
+    def append(self, q_list, a_list, vocab):
+        """
+        追加分好词的问句与答案，返回新的矩阵，原有问句的序号不变
+
+        原有问句的权重与各词的 idf 保持不变，新词的 idf 按追加后的问句数量计算；
+        精确的 idf 需要完整重建
+        """
+        n = self.size + len(q_list)
+        old_dim = len(self.idf)
+        dim = max(max(vocab.values()) + 1, old_dim)
+
+        term_list, doc_list, tf_list = list(), list(), list()
+        for i, q in enumerate(q_list, self.size):
+            for w, tf in Counter(q).items():
+                term_list.append(vocab[w])
+                doc_list.append(i)
+                tf_list.append(tf)
+        terms = np.array(term_list, dtype=np.int64)
+        docs = np.array(doc_list, dtype=np.uint32)
+        tfs = np.array(tf_list, dtype=np.float32)
+
+        df = np.bincount(terms, minlength=dim)
+        idf = np.zeros(dim, dtype=np.float32)
+        idf[:old_dim] = self.idf
+        idf[old_dim:] = np.log((1 + n) / (1 + df[old_dim:])) + 1
+
+        weights = tfs * idf[terms]
+        norms = np.sqrt(np.bincount(docs, weights=weights ** 2, minlength=n))
+        weights /= np.maximum(norms[docs], 1e-12).astype(np.float32)
+
+        # 与原有的行合并，重新按词序号排序
+        old_terms = np.repeat(np.arange(old_dim), np.diff(self.offsets).astype(np.int64))
+        terms = np.concatenate([old_terms, terms])
+        docs = np.concatenate([self.docs, docs])
+        weights = np.concatenate([self.weights, weights])
+        order = np.lexsort((docs, terms))
+        offsets = np.zeros(dim + 1, dtype=np.uint32)
+        np.cumsum(np.bincount(terms, minlength=dim), out=offsets[1:])
+
+        answers = [''.join(a).encode('utf-8') for a in a_list]
+        answer_offsets = np.zeros(len(answers) + 1, dtype=np.uint64)
+        np.cumsum([len(a) for a in answers], out=answer_offsets[1:])
+        answer_offsets = np.concatenate([self.answer_offsets, answer_offsets[1:] + self.answer_offsets[-1]])
+        answer_data = np.concatenate([self.answer_data, np.frombuffer(b''.join(answers), dtype=np.uint8)])
+
+        return type(self)(offsets, docs[order], weights[order], idf, answer_offsets, answer_data)
+
+    def save(self, path):
+        with atomic_write(path, 'wb') as f:
+            np.savez(f, offsets=self.offsets, docs=self.docs, weights=self.weights, idf=self.idf,
+                     answer_offsets=self.answer_offsets, answer_data=self.answer_data)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['offsets'], data['docs'], data['weights'], data['idf'],
+                       data['answer_offsets'], data['answer_data'])
+
+    def answer(self, i):
+        """获取第 i 个问句对应的答案"""
+        start, end = self.answer_offsets[i], self.answer_offsets[i + 1]
+        return self.answer_data[start:end].tobytes().decode('utf-8')
+
+    def query_vector(self, word_ids, unknown=0):
+        """
+        计算问句的 tf-idf 向量
+
+        返回 (词序号, 权重) 以及向量的模，unknown 为未登录词的个数，只计入向量的模
+        """
+        counter = Counter(i for i in word_ids if i < len(self.idf))
+        unknown += len(word_ids) - sum(counter.values())
+        terms = np.fromiter(counter.keys(), dtype=np.int64, count=len(counter))
+        tfs = np.fromiter(counter.values(), dtype=np.float32, count=len(counter))
+        weights = tfs * self.idf[terms]
+        norm = np.sqrt(np.sum(weights ** 2) + unknown * self.unknown_idf ** 2)
+        return terms, weights, norm
+
+    def similarity(self, word_ids, unknown=0):
+        """问句与所有问句的余弦相似度"""
+        terms, weights, norm = self.query_vector(word_ids, unknown)
+        if not len(terms) or norm == 0:
+            return np.zeros(self.size, dtype=np.float32)
+
+        # 稀疏矩阵与向量的乘法：取出问句中各词的行，按问句序号累加
+        starts, ends = self.offsets[terms], self.offsets[terms + 1]
+        rows = [np.arange(s, e) for s, e in zip(starts, ends)]
+        index = np.concatenate(rows)
+        scale = np.repeat(weights, ends - starts)
+        scores = np.bincount(self.docs[index], weights=self.weights[index] * scale, minlength=self.size)
+        return scores / norm
+
+    def similarity_batch(self, word_ids_list, unknowns):
+        """
+        多个问句与所有问句的余弦相似度，返回 (问句数, 语料库问句数) 的矩阵
+
+        所有问句的各词的行一起取出，按 (问句, 语料库问句) 一次累加，
+        每个元素的累加顺序与 similarity 相同，结果完全一致
+        """
+        n = len(word_ids_list)
+        norms = np.ones(n, dtype=np.float64)
+        index_list, scale_list, row_list = list(), list(), list()
+        for row, (word_ids, unknown) in enumerate(zip(word_ids_list, unknowns)):
+            terms, weights, norm = self.query_vector(word_ids, unknown)
+            if not len(terms) or norm == 0:
+                continue
+            norms[row] = norm
+            starts, ends = self.offsets[terms], self.offsets[terms + 1]
+            index_list += [np.arange(s, e) for s, e in zip(starts, ends)]
+            scale_list.append(np.repeat(weights, ends - starts))
+            row_list.append(np.full(int(np.sum(ends - starts)), row, dtype=np.int64))
+
+        if not index_list:
+            return np.zeros((n, self.size), dtype=np.float64)
+        index = np.concatenate(index_list)
+        scale = np.concatenate(scale_list)
+        cells = np.concatenate(row_list) * self.size + self.docs[index]
+        scores = np.bincount(cells, weights=self.weights[index] * scale, minlength=n * self.size)
+        return scores.reshape(n, self.size) / norms[:, None]
+
+    def search(self, word_ids, unknown=0, k=3):
+        """返回相似度最高的 k 个问句 [(序号, 相似度)]，相似度相同时序号小的在前"""
+        return self.top_k(self.similarity(word_ids, unknown), k)
+
+    def search_batch(self, word_ids_list, unknowns, k=3, max_cells=1 << 22):
+        """
+        多个问句的 search，结果与逐个调用相同
+
+        每次计算的相似度矩阵不超过 max_cells 个元素，问句较多时分批计算
+        """
+        results = list()
+        step = max(max_cells // max(self.size, 1), 1)
+        for start in range(0, len(word_ids_list), step):
+            scores = self.similarity_batch(word_ids_list[start:start + step], unknowns[start:start + step])
+            results += [self.top_k(row, k) for row in scores]
+        return results
+
+    def top_k(self, scores, k):
+        """相似度最高的 k 个问句，只保留相似度大于 0 的，相似度相同时序号小的在前"""
+        k = min(k, self.size)
+        if k <= 0:
+            return list()
+        # 与第 k 大的相似度相同的问句都作为候选，再按 (相似度, 序号) 排序，避免 argpartition 任意取舍
+        kth = np.partition(scores, self.size - k)[self.size - k]
+        top = np.flatnonzero(scores >= kth)
+        top = top[np.lexsort((top, -scores[top]))][:k]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0]
+
+
+class SemanticIndex:
+    """
+    语料库问句的句向量矩阵
+
+        句向量为问句中各词 word2vec 词向量的平均值，归一化后以 float16 保存，
+        查询时只需一次矩阵与向量的乘法即得到与所有问句的余弦相似度，不依赖 gensim。
+        问句数量超过 IVF_MIN_SIZE 时，额外以 k-means 将句向量划分为若干簇（IVF），
+        查询时只计算与问句最接近的 n_probe 个簇
+    """
+
+    IVF_MIN_SIZE = 50000
+
+    # 分块计算，避免 float16 矩阵整体转换为 float32
+    BLOCK_SIZE = 1 << 16
+
+    def __init__(self, words, word_vectors, matrix, centroids=None, list_offsets=None, list_docs=None):
+        self.word_index = dict(zip(words, range(len(words))))
+        self.word_vectors = word_vectors
+        self.matrix = matrix
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_docs = list_docs
+        self.size = len(matrix)
+
+    @staticmethod
+    def normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def build(cls, offsets, ids, vocab, words, word_vectors, n_lists=None):
+        """
+        根据问句的词序号序列与词向量构建句向量矩阵，问句较多时同时构建 IVF 索引
+
+            offsets, ids：WordWorker.build_index 保存的词序号序列，第 i 个问句为 ids[offsets[i]:offsets[i + 1]]
+            vocab：{词: 词序号}，没有词向量的词不计入句向量
+        """
+        index = cls(words, word_vectors.astype(np.float16), np.zeros((0, word_vectors.shape[1]), np.float16))
+        vectors = index.word_vectors.astype(np.float32)
+
+        # 词序号 -> 词向量的行号，没有词向量时为 -1
+        rows = np.full(max(vocab.values()) + 1, -1, dtype=np.int64)
+        for w, i in vocab.items():
+            rows[i] = index.word_index.get(w, -1)
+
+        # 分块按问句累加词向量，归一化后与 embed 的结果相同
+        size = len(offsets) - 1
+        matrix = np.zeros((size, vectors.shape[1]), dtype=np.float16)
+        for start in range(0, size, cls.BLOCK_SIZE):
+            stop = min(start + cls.BLOCK_SIZE, size)
+            token_rows = rows[ids[offsets[start]:offsets[stop]]]
+            owners = np.repeat(np.arange(stop - start), np.diff(offsets[start:stop + 1]).astype(np.int64))
+            known = token_rows >= 0
+            sums = np.zeros((stop - start, vectors.shape[1]), dtype=np.float32)
+            np.add.at(sums, owners[known], vectors[token_rows[known]])
+            matrix[start:stop] = cls.normalize(sums)
+        index.matrix = matrix
+        index.size = len(matrix)
+
+        if n_lists is None and index.size >= cls.IVF_MIN_SIZE:
+            n_lists = int(np.sqrt(index.size))
+        if n_lists:
+            index.build_ivf(n_lists)
+        return index
+
+    def build_ivf(self, n_lists, n_iter=10, seed=0):
+        """以 k-means 将句向量划分为 n_lists 个簇"""
+        rng = np.random.RandomState(seed)
+        centroids = self.matrix[rng.choice(self.size, n_lists, replace=False)].astype(np.float32)
+        for _ in range(n_iter):
+            assign = self.assign(centroids)
+            sums = np.zeros_like(centroids)
+            for start in range(0, self.size, self.BLOCK_SIZE):
+                block = self.matrix[start:start + self.BLOCK_SIZE].astype(np.float32)
+                np.add.at(sums, assign[start:start + len(block)], block)
+            counts = np.bincount(assign, minlength=n_lists)
+            nonempty = counts > 0
+            centroids[nonempty] = self.normalize(sums[nonempty])
+
+        assign = self.assign(centroids)
+        order = np.argsort(assign, kind='stable')
+        self.centroids = centroids.astype(np.float16)
+        self.list_offsets = np.zeros(n_lists + 1, dtype=np.uint64)
+        np.cumsum(np.bincount(assign, minlength=n_lists), out=self.list_offsets[1:])
+        self.list_docs = order.astype(np.uint32)
+
+    def assign(self, centroids):
+        """将每个句向量分配到最近的簇"""
+        assign = np.zeros(self.size, dtype=np.int64)
+        for start in range(0, self.size, self.BLOCK_SIZE):
+            block = self.matrix[start:start + self.BLOCK_SIZE].astype(np.float32)
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return assign
+
+    def save(self, path):
+        words = sorted(self.word_index, key=self.word_index.get)
+        arrays = {'words': np.array('\n'.join(words).encode('utf-8')),
+                  'word_vectors': self.word_vectors, 'matrix': self.matrix}
+        if self.centroids is not None:
+            arrays.update(centroids=self.centroids, list_offsets=self.list_offsets, list_docs=self.list_docs)
+        with atomic_write(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            words = data['words'].item().decode('utf-8').split('\n')
+            ivf = [data[k] if k in data else None for k in ('centroids', 'list_offsets', 'list_docs')]
+            return cls(words, data['word_vectors'], data['matrix'], *ivf)
+
+    def embed(self, words):
+        """句向量：各词的词向量取平均后归一化，没有已知词时返回 None"""
+        rows = [self.word_index[w] for w in words if w in self.word_index]
+        if not rows:
+            return None
+        vec = self.word_vectors[rows].astype(np.float32).mean(axis=0)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return None
+        return vec / norm
+
+    def similarity(self, vec, docs=None):
+        """句向量与问句（全部或 docs 中的）的余弦相似度"""
+        if docs is not None:
+            return self.matrix[docs].astype(np.float32) @ vec
+        scores = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, self.BLOCK_SIZE):
+            block = self.matrix[start:start + self.BLOCK_SIZE]
+            scores[start:start + len(block)] = block.astype(np.float32) @ vec
+        return scores
+
+    def coverage(self, words):
+        """问句中有词向量的词所占的比例"""
+        if not words:
+            return 0.0
+        return sum(w in self.word_index for w in words) / len(words)
+
+    def search(self, words, k=1, n_probe=8):
+        """
+        返回相似度最高的 k 个问句 [(序号, 相似度)]
+
+        句向量只由已知词计算，相似度再乘以已知词所占的比例：
+        未知词越多，剩下的虚词越难代表问句的意思，相似度相应降低
+        """
+        vec = self.embed(words)
+        if vec is None or self.size == 0:
+            return list()
+        coverage = self.coverage(words)
+
+        if self.centroids is None:
+            docs = np.arange(self.size)
+            scores = self.similarity(vec)
+        else:
+            near = np.argsort(-(self.centroids.astype(np.float32) @ vec))[:n_probe]
+            docs = np.concatenate([self.list_docs[self.list_offsets[c]:self.list_offsets[c + 1]] for c in near])
+            scores = self.similarity(vec, docs)
+
+        k = min(k, len(docs))
+        if k <= 0:
+            return list()
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((docs[top], -scores[top]))]
+        return [(int(docs[i]), float(scores[i]) * coverage) for i in top]
 
 
 class WordWorker:
 
+    # 语料索引的构建版本，修改构建逻辑时递增，使已有索引失效
+    BUILD_VERSION = 3
+
+    # 影响语料索引的源文件（分词结果依赖自定义词典）
+    BUILD_SOURCES = [SEQ_CORPUS_PATH, SPECIAL_WORDS_PATH, MEDICAL_SPECIAL_WORDS_PATH]
+
+    BUILD_OUTPUTS = [VOCABULARY_PATH, CORPUS_INDEX_PATH, QUESTION_IDS_PATH]
+
+    # 进程内共享的 tf-idf 矩阵：((修改时间, 大小), CorpusIndex)
+    _matrix = None
+    _matrix_lock = threading.Lock()
+
     pad = 0
     start = 1
     end = 2
@@ -60,20 +503,24 @@ class WordWorker:
 
     @staticmethod
     def load_special_words():
-        """加载固定词语，禁止分词"""
-        jieba.load_userdict(SPECIAL_WORDS_PATH)
-        jieba.load_userdict(MEDICAL_SPECIAL_WORDS_PATH)
+        """加载固定词语，禁止分词（已合并进共享分词器的前缀词典，每个进程只加载一次）"""
+        return get_segmenter()
 
     @staticmethod
-    def load_seq_qa():
+    def cut_line(line):
+        """对语料库中的一行分词：去除首尾空白与数字"""
+        line = line.strip()
+        line = re.sub(r'[0-9]*', '', line)
+        return get_segmenter().lcut(line)
+
+    @classmethod
+    def load_seq_qa(cls):
         """从序列语料库中加载语料"""
         q_list = list()
         a_list = list()
         with open(SEQ_CORPUS_PATH, 'r', encoding='utf-8') as f:
             for i, line in enumerate(f):
-                line = line.strip()
-                line = re.sub(r'[0-9]*', '', line)
-                line = jieba.lcut(line)
+                line = cls.cut_line(line)
                 if i % 2 == 0:
                     q_list.append(line)
                 if i % 2 == 1:
@@ -87,7 +534,7 @@ class WordWorker:
 
     def build_vocab(self):
         """根据问句建立字典，键为词、值为序号"""
-        q_list, _ = self.load_seq_qa()
+        q_list = self.question_list
         vocab = set()
 
         # 对每个问句分词
@@ -99,8 +546,7 @@ class WordWorker:
         word_dict['<end>'] = self.end
         word_dict['<start>'] = self.start
 
-        with open(VOCABULARY_PATH, 'w', encoding='utf-8') as f:
-            json.dump(word_dict, f, ensure_ascii=False)
+        self.save_json(word_dict, VOCABULARY_PATH)
         self.print_log('Vocabulary is completed.')
 
     @staticmethod
@@ -110,29 +556,223 @@ class WordWorker:
             vocab = json.load(f)
         return vocab
 
-    def build_inverse(self):
-        """根据问句构建倒排索引"""
-        vocab = self.get_vocab()
-        q_list, _ = self.load_seq_qa()
-        inverse_index_dict = dict().fromkeys(vocab.keys())
-        for k in inverse_index_dict:
-            inverse_index_dict[k] = list()
+    @staticmethod
+    def save_json(data, path):
+        with atomic_write(path) as f:
+            json.dump(data, f, ensure_ascii=False)
 
-        # 记录出现相应的词的文档，建立倒排索引
-        for i, qw in enumerate(q_list):
-            for w in qw:
-                inverse_index_dict[w].append(i)
+    @staticmethod
+    def read_chunks(chunk_size):
+        """按块读取语料库，每块为 [(问句, 答案), ...]，末尾没有答案的问句被忽略"""
+        chunk = list()
+        with open(SEQ_CORPUS_PATH, 'r', encoding='utf-8') as f:
+            for q, a in zip(f, f):
+                chunk.append((q, a))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = list()
+        if chunk:
+            yield chunk
+
+    @classmethod
+    def cut_chunk(cls, chunk):
+        """处理一块语料：问句分词；答案不参与检索，只需去除首尾空白与数字"""
+        return [(cls.cut_line(q), re.sub(r'[0-9]*', '', a.strip())) for q, a in chunk]
+
+    @classmethod
+    def iter_segmented(cls, processes=None, chunk_size=2000):
+        """
+        流式分词：按块读取语料库，交给进程池分词，按原顺序依次产生每块的结果
+
+        同时处理的块不超过进程数的两倍，内存占用与语料库大小无关；
+        只有一块或 processes 为 1 时在当前进程中分词
+        """
+        processes = processes or os.cpu_count() or 1
+        chunks = cls.read_chunks(chunk_size)
+        first = list(itertools.islice(chunks, 2))
+        chunks = itertools.chain(first, chunks)
+        if processes == 1 or len(first) < 2:
+            for chunk in chunks:
+                yield cls.cut_chunk(chunk)
+            return
+
+        # 子进程启动时加载共享分词器（fork 时直接继承父进程已加载的词典）
+        with multiprocessing.Pool(processes, initializer=get_segmenter) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(cls.cut_chunk, (chunk,)))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    @classmethod
+    def build_index(cls, processes=None, chunk_size=2000):
+        """
+        对语料库只分词一次，同时生成字典、tf-idf 矩阵以及问句的词序号序列
+
+            词序号按首次出现的顺序分配；分词结果用完即丢弃，
+            只保留紧凑的数组：(词序号, 问句序号, 词频) 三元组、问句的词序号序列与答案文本
+
+        构建期间持有语料库锁，与 append_qa 互斥
+        """
+        with file_lock(CORPUS_LOCK_PATH):
+            vocab = {'<pos>': cls.pad, '<start>': cls.start, '<end>': cls.end}
+            terms, docs, tfs = array('I'), array('I'), array('I')
+            token_ids, token_offsets = array('I'), array('Q', [0])
+            answer_data, answer_offsets = bytearray(), array('Q', [0])
+
+            n = 0
+            for chunk in cls.iter_segmented(processes, chunk_size):
+                for q, a in chunk:
+                    ids = [vocab.setdefault(w, len(vocab)) for w in q]
+                    token_ids.extend(ids)
+                    token_offsets.append(len(token_ids))
+                    for i, tf in Counter(ids).items():
+                        terms.append(i)
+                        docs.append(n)
+                        tfs.append(tf)
+                    answer_data += a.encode('utf-8')
+                    answer_offsets.append(len(answer_data))
+                    n += 1
+
+            terms = np.frombuffer(terms, dtype=np.uint32)
+            docs = np.frombuffer(docs, dtype=np.uint32)
+            tfs = np.frombuffer(tfs, dtype=np.uint32)
+
+            corpus_index = CorpusIndex.from_counts(terms, docs, tfs, n, len(vocab),
+                                                   np.frombuffer(answer_offsets, dtype=np.uint64),
+                                                   np.frombuffer(bytes(answer_data), dtype=np.uint8))
+
+            cls.save_json(vocab, VOCABULARY_PATH)
+            cls.save_question_ids(np.frombuffer(token_offsets, dtype=np.uint64),
+                                  np.frombuffer(token_ids, dtype=np.uint32))
+            corpus_index.save(CORPUS_INDEX_PATH)
+            logging.getLogger().warning(f'Corpus index is completed: {n} QA pairs, {len(vocab)} words.')
 
-        with open(INVERSE_INDEX_PATH, 'w', encoding='utf-8') as f:
-            json.dump(inverse_index_dict, f, ensure_ascii=False)
-        self.print_log('Inverse index is completed.')
+    @staticmethod
+    def save_question_ids(offsets, ids):
+        """保存问句的词序号序列：第 i 个问句为 ids[offsets[i]:offsets[i + 1]]"""
+        with atomic_write(QUESTION_IDS_PATH, 'wb') as f:
+            np.savez(f, offsets=offsets, ids=ids)
+
+    @staticmethod
+    def get_question_ids():
+        """读取问句的词序号序列，返回 (offsets, ids)"""
+        with np.load(QUESTION_IDS_PATH) as data:
+            return data['offsets'], data['ids']
+
+    @classmethod
+    def get_matrix(cls):
+        """读取 tf-idf 矩阵，文件未变化时各层共用同一份（矩阵只读，追加时生成新的矩阵）"""
+        stat = os.stat(CORPUS_INDEX_PATH)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with cls._matrix_lock:
+            if cls._matrix is None or cls._matrix[0] != stamp:
+                cls._matrix = (stamp, CorpusIndex.load(CORPUS_INDEX_PATH))
+            return cls._matrix[1]
+
+    @classmethod
+    def get_inverse(cls):
+        """
+        倒排索引 {词: [问句序号, ...]}，词在问句中每出现一次记录一次问句序号，问句序号升序
+
+        由问句的词序号序列生成，追加问答后无需另外维护
+        """
+        vocab = cls.get_vocab()
+        offsets, ids = cls.get_question_ids()
+        words = sorted(vocab, key=vocab.get)
+        docs = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets).astype(np.int64))
+        docs = docs[np.argsort(ids, kind='stable')]
+        bounds = np.cumsum(np.bincount(ids, minlength=max(vocab.values()) + 1))
+        postings = np.split(docs, bounds[:-1])
+        return {w: postings[vocab[w]].tolist() for w in words}
+
+    @staticmethod
+    def get_questions():
+        """读取语料库中的原始问句（不分词）"""
+        with open(SEQ_CORPUS_PATH, 'r', encoding='utf-8') as f:
+            return [line.strip() for i, line in enumerate(f) if i % 2 == 0]
 
     @staticmethod
-    def get_inverse():
-        """读取倒排索引"""
-        with open(INVERSE_INDEX_PATH, 'r', encoding='utf-8') as f:
-            inverse_index = json.load(f)
-        return inverse_index
+    def find_question(corpus_index, offsets, ids, word_ids):
+        """
+        返回词序号序列与 word_ids 相同的问句序号，没有时返回 None
+
+        只比较包含第一个词的问句（即 tf-idf 矩阵中该词的行），无需读取语料库
+        """
+        term = word_ids[0]
+        if term >= len(corpus_index.idf):
+            return None
+        docs = corpus_index.docs[corpus_index.offsets[term]:corpus_index.offsets[term + 1]].astype(np.int64)
+        starts = offsets.astype(np.int64)
+        docs = docs[starts[docs + 1] - starts[docs] == len(word_ids)]
+        if not len(docs):
+            return None
+        rows = ids[starts[docs][:, None] + np.arange(len(word_ids))]
+        same = np.flatnonzero((rows == np.array(word_ids, dtype=ids.dtype)).all(axis=1))
+        return int(docs[same[0]]) if len(same) else None
+
+    @classmethod
+    def append_qa(cls, pairs):
+        """
+        向语料库追加问答对，并增量更新字典、tf-idf 矩阵与问句的词序号序列，无需对整个语料库重新分词
+
+            pairs = [(问句, 答案), ...]，空问答以及分词结果与已有问句相同的问句会被跳过
+            （相似度相同时序号小的问句在前，重复的问句不会被选中）
+            新词的序号在已有最大序号之后依次分配；原有问句的序号不变
+
+        追加期间持有语料库锁，多个进程同时追加或与 build_index 同时执行时依次进行；
+        语料库索引文件最后写入，正在运行的 LayerFilter 据此重新加载；返回实际追加的数量
+        """
+        with file_lock(CORPUS_LOCK_PATH):
+            vocab = cls.get_vocab()
+            corpus_index = cls.get_matrix()
+            offsets, ids = cls.get_question_ids()
+
+            new_pairs, q_list, a_list = list(), list(), list()
+            seen = set()
+            for q, a in pairs:
+                q, a = ' '.join(q.split()), ' '.join(a.split())
+                words = cls.cut_line(q)
+                if not words or not a or tuple(words) in seen:
+                    continue
+                if all(w in vocab for w in words) and \
+                        cls.find_question(corpus_index, offsets, ids, [vocab[w] for w in words]) is not None:
+                    continue
+                seen.add(tuple(words))
+                new_pairs.append((q, a))
+                q_list.append(words)
+                a_list.append(cls.cut_line(a))
+            if not new_pairs:
+                return 0
+
+            # 新词依次分配序号
+            next_id = max(vocab.values()) + 1
+            for q in q_list:
+                for w in q:
+                    if w not in vocab:
+                        vocab[w] = next_id
+                        next_id += 1
+
+            # 文件末尾没有换行时先补上，否则追加的问句会与最后一个答案连在一起
+            content = ''.join(f'{q}\n{a}\n' for q, a in new_pairs).encode('utf-8')
+            with open(SEQ_CORPUS_PATH, 'rb') as f:
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        content = b'\n' + content
+
+            new_ids = [vocab[w] for q in q_list for w in q]
+            new_offsets = offsets[-1] + np.cumsum([len(q) for q in q_list], dtype=np.uint64)
+
+            cls.save_json(vocab, VOCABULARY_PATH)
+            cls.save_question_ids(np.concatenate([offsets, new_offsets]),
+                                  np.concatenate([ids, np.array(new_ids, dtype=np.uint32)]))
+            with open(SEQ_CORPUS_PATH, 'ab') as f:
+                f.write(content)
+            corpus_index.append(q_list, a_list, vocab).save(CORPUS_INDEX_PATH)
+            return len(new_pairs)
 
     def sent2vec(self, ml=0, limit=999):
         """将句子转换成句子向量，每个词以数字表示"""
@@ -163,15 +803,39 @@ class WordWorker:
         return to_vec(q_list)
 
     def build_word2vec(self, skip_gram=False):
+        from gensim.models import Word2Vec
+
         word2vec = Word2Vec(self.qa_list, size=100, sg=skip_gram, min_count=1)
         word2vec.save(WORD2VEC_MODEL_PATH)
         self.print_log(f'Word2Vec 训练完成！ --- {WORD2VEC_MODEL_PATH}')
 
-    def get_word2vec(self):
+    @staticmethod
+    def get_word2vec():
+        from gensim.models import Word2Vec
+
         word2vec = Word2Vec.load(WORD2VEC_MODEL_PATH)
-        self.print_log('Word2Vec 加载完成！')
+        logging.getLogger().warning('Word2Vec 加载完成！')
         return word2vec
 
+    @classmethod
+    def build_sentence_vectors(cls):
+        """
+        以 word2vec 词向量生成语料库问句的句向量矩阵，查询时不再需要 gensim
+
+        问句取自 build_index 保存的词序号序列与字典，不再读取、分词语料库
+        """
+        wv = cls.get_word2vec().wv
+        words = wv.index_to_key if hasattr(wv, 'index_to_key') else wv.index2word
+        offsets, ids = cls.get_question_ids()
+        semantic_index = SemanticIndex.build(offsets, ids, cls.get_vocab(), list(words), wv.vectors)
+        semantic_index.save(SENTENCE_VECTOR_PATH)
+        logging.getLogger().warning(f'Sentence vectors are completed. --- {SENTENCE_VECTOR_PATH}')
+
+    @staticmethod
+    def get_sentence_vectors():
+        """读取句向量矩阵"""
+        return SemanticIndex.load(SENTENCE_VECTOR_PATH)
+
 
 class LTPWorker:
     """LTP 云平台相关功能"""
@@ -223,7 +887,6 @@ class LTPWorker:
 
 # wf = WordFactory()
 # wf.build_vocab()
-# wf.build_inverse()
 # vecs = wf.sent2vec()
 # print(list(vecs))
 # wf.build_word2vec()
@@ -8,38 +8,211 @@
     如果最终没有获得相关答案则返回默认答案
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+import itertools
+import threading
+import time
+
+from tokenizer import Segmenter, get_segmenter
+from manifest import BuildManifest
+from cache import ResultCache
+from metrics import Metrics
 from layer import *
 
-jieba.setLogLevel('INFO')
+
+# 一次回答：text 为答案，layer 为给出答案的层名（Command：模式命令，Default：默认答案），latency 为耗时（秒）
+Reply = namedtuple('Reply', ['text', 'layer', 'latency'])
+
+
+class Session:
+    """
+    一个会话的设置，由该会话的模式命令修改，不影响其他会话
+
+        internet：是否在本地各层之后联网搜索
+    """
+
+    def __init__(self, internet=False):
+        self.internet = internet
+
+    def __repr__(self):
+        return f'Session(internet={self.internet})'
 
 
 class LayerFilter:
-    INTERNET = False
+    # 会话的模式与状态命令
+    COMMANDS = ('Robot-单机模式', 'Robot-联网模式', 'Robot-状态')
+
+    # 检查语料库索引是否被追加（文件变化）的最短间隔，单位秒
+    CORPUS_CHECK_INTERVAL = 1.0
+
+    def __init__(self, concurrency=0, cache_size=10000, warm_up=False, semantic=False):
+        """
+        concurrency 为各层并发执行的线程数，为 0 时各层依次执行
+
+        cache_size 为结果缓存保存的问句数量
 
-    def __init__(self):
+        各层在首次使用时才加载数据，warm_up 为 True 时启动后台线程提前依次加载
+
+        semantic 为 True 时启用句向量检索层（SemanticSearch），默认不启用
+        """
+        self.warm_up = warm_up
+        self.semantic = semantic
+        self.executor = ThreadPoolExecutor(concurrency) if concurrency else None
+        self.manifest = BuildManifest()
+        self.result_cache = ResultCache(cache_size)
+        self.metrics = Metrics()
+        # 多进程服务时由工作进程设置（WorkerMetrics），运行指标为所有工作进程合并后的
+        self.worker_metrics = None
+        self.session = Session()
+        self.internet = None
+        self.internet_lock = threading.Lock()
+        self.corpus_lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """
+        重新构建有变化的数据并创建各层，同时清空结果缓存
+
+        修改模板、语料库或知识图谱的数据后调用
+        """
+        self.make_segmenter()
         self.make_word_worker()
         self.default_answers = self.get_default()
-        self.pipeline = [Template(), CorpusSearch(), self.make_medical()]
+        self.medical = self.make_medical()
+        pipeline = [Template(), CorpusSearch(), self.medical]
+        semantic = self.make_semantic() if self.semantic else None
+        if semantic:
+            pipeline.append(semantic)
+        for p in pipeline:
+            self.attach_metrics(p)
+
+        # 各层在运行中不再修改，请求之间共享；重新加载时整体替换
+        self.pipeline = tuple(pipeline)
+        self.corpus_stamp = self.get_corpus_stamp()
+        self.corpus_checked = time.monotonic()
+        self.result_cache.clear()
+        if self.warm_up:
+            threading.Thread(target=self.warm_up_layers, args=(pipeline,), name='warm-up', daemon=True).start()
 
     @staticmethod
-    def make_word_worker(build=True):
-        """初始化语料库的倒排索引"""
+    def warm_up_layers(pipeline):
+        """按层的先后顺序加载分词器与各层的数据，加载出错的层在首次使用时重试"""
+        start = time.perf_counter()
+        get_segmenter()
+        for p in pipeline:
+            try:
+                p.ensure_loaded()
+            except Exception:
+                logging.getLogger().exception(f'{p.name} failed to load')
+        logging.getLogger().warning(f'All layers are loaded in {time.perf_counter() - start:.2f} s.')
 
-        ww = WordWorker()
-        if build:
-            ww.build_vocab()
-            ww.build_inverse()
+    def attach_metrics(self, layer):
+        """为层设置运行指标，同名的层共用同一份统计"""
+        layer.metrics = self.metrics.layer(layer.name)
+        return layer
 
     @staticmethod
-    def make_medical(build=True):
-        """初始化医疗知识图谱"""
+    def get_corpus_stamp():
+        stat = os.stat(CORPUS_INDEX_PATH)
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh_corpus(self):
+        """
+        语料库通过 WordWorker.append_qa 追加问答后，重新加载字典与语料库相关的层，并清空结果缓存
+
+        每隔 CORPUS_CHECK_INTERVAL 秒检查一次语料库索引文件
+        """
+        now = time.monotonic()
+        if now - self.corpus_checked < self.CORPUS_CHECK_INTERVAL:
+            return
+        # 多个请求同时检查时只由一个线程重新加载
+        if not self.corpus_lock.acquire(blocking=False):
+            return
+        try:
+            self.corpus_checked = now
+            stamp = self.get_corpus_stamp()
+            if stamp == self.corpus_stamp:
+                return
+
+            self.corpus_stamp = stamp
+            for p in self.pipeline:
+                # 尚未加载的层在首次使用时会直接加载新的数据
+                if isinstance(p, (CorpusSearch, SemanticSearch)) and p.loaded:
+                    p.reload()
+            self.result_cache.clear()
+            logging.getLogger().warning('Corpus is reloaded.')
+        finally:
+            self.corpus_lock.release()
+
+    def make_segmenter(self):
+        """
+        自定义词典变化时重建共享分词器的前缀词典
+
+        未变化时不加载，首次分词时直接加载已序列化的前缀词典
+        """
+
+        sources = Segmenter.BUILD_SOURCES
+        outputs = Segmenter.BUILD_OUTPUTS
+        if self.manifest.is_stale('tokenizer', Segmenter.BUILD_VERSION, sources, outputs):
+            get_segmenter(rebuild=True)
+            self.manifest.update('tokenizer', Segmenter.BUILD_VERSION, sources, outputs)
+
+    def make_word_worker(self, build=True):
+        """初始化语料库的倒排索引，源文件未变化时直接使用已有索引"""
+
+        sources = WordWorker.BUILD_SOURCES
+        outputs = WordWorker.BUILD_OUTPUTS
+        if build and self.manifest.is_stale('corpus', WordWorker.BUILD_VERSION, sources, outputs):
+            WordWorker.build_index()
+            self.manifest.update('corpus', WordWorker.BUILD_VERSION, sources, outputs)
+
+    def make_medical(self, build=True):
+        """初始化医疗知识图谱，源数据未变化时直接使用已有的结点、边文件"""
 
         entities = ['name', 'symptom', 'common_drug', 'recommand_drug', 'check', 'category']
-        medical_search = MedicalSearch(MEDICAL_ORIGIN_INDEX_PATH, entities, 'name')
-        if build:
+        medical_search = MedicalSearch(MEDICAL_ORIGIN_INDEX_PATH, entities, 'name', load=False)
+        sources = [MEDICAL_ORIGIN_INDEX_PATH]
+        outputs = medical_search.graph_files()
+        if build and self.manifest.is_stale('medical', MedicalSearch.BUILD_VERSION, sources, outputs):
             medical_search.build_graph()
+            self.manifest.update('medical', MedicalSearch.BUILD_VERSION, sources, outputs)
+
+        # 由结点、边文件生成内存映射的二进制图谱
+        sources = outputs
+        outputs = [MEDICAL_GRAPH_PATH]
+        if self.manifest.is_stale('medical_graph', GraphStore.VERSION, sources, outputs):
+            medical_search.build_store()
+            self.manifest.update('medical_graph', GraphStore.VERSION, sources, outputs)
+
+        # 由原始数据生成疾病的记录库，原始数据缺失时使用已有的记录库
+        sources = [MEDICAL_ORIGIN_INDEX_PATH]
+        outputs = [MEDICAL_RECORDS_PATH]
+        if build and self.manifest.is_stale('medical_records', RecordStore.VERSION, sources, outputs):
+            if os.path.exists(MEDICAL_ORIGIN_INDEX_PATH):
+                medical_search.build_records()
+                self.manifest.update('medical_records', RecordStore.VERSION, sources, outputs)
+            else:
+                logging.getLogger().warning(f'Record store is not built, missing: {MEDICAL_ORIGIN_INDEX_PATH}')
+
         return medical_search
 
+    def make_semantic(self, build=True):
+        """初始化语料库问句的句向量，构建需要 gensim，无法构建且没有已有句向量时不启用该层"""
+
+        sources = [WORD2VEC_MODEL_PATH] + WordWorker.BUILD_SOURCES
+        outputs = [SENTENCE_VECTOR_PATH]
+        if build and self.manifest.is_stale('semantic', WordWorker.BUILD_VERSION, sources, outputs):
+            try:
+                WordWorker.build_sentence_vectors()
+                self.manifest.update('semantic', WordWorker.BUILD_VERSION, sources, outputs)
+            except ImportError as e:
+                logging.getLogger().warning(f'Sentence vectors are not built: {e}')
+
+        if not os.path.exists(SENTENCE_VECTOR_PATH):
+            return None
+        return SemanticSearch()
+
     @staticmethod
     def get_default():
         """加载默认答案"""
@@ -50,29 +223,335 @@ class LayerFilter:
             answers.append(a.text)
         return answers
 
-    def get_answer(self, question):
+    @staticmethod
+    def make_query(question):
+        """
+        创建各层共享的问句分析结果
+
+        分词、查询词序号、提取医疗实体均在首次需要时进行，且只进行一次，
+        模板层命中的问句无需分词
+        """
+        return Query(question)
+
+    def get_internet(self):
+        """所有会话共享的 InterNet 层，首次开启联网模式时创建"""
+        if self.internet is None:
+            with self.internet_lock:
+                if self.internet is None:
+                    self.internet = self.attach_metrics(InterNet())
+        return self.internet
+
+    def get_pipeline(self, session):
+        """会话所使用的各层"""
+        if session.internet:
+            return self.pipeline + (self.get_internet(),)
+        return self.pipeline
+
+    def get_answer(self, question, session=None):
         """获取答案"""
+        return self.get_reply(question, session).text
+
+    def get_reply(self, question, session=None):
+        """
+        获取答案，同时给出回答的层与耗时
+
+        session 为会话设置，为 None 时使用 LayerFilter 自身的默认会话
+        """
+        start = time.perf_counter()
+        answer, layer = self.answer(question, session or self.session)
+        reply = Reply(answer, layer, time.perf_counter() - start)
+        self.metrics.observe_request(layer, reply.latency)
+        return reply
+
+    def get_answers(self, questions, session=None):
+        """批量获取答案，与逐个调用 get_answer 的结果相同"""
+        return [reply.text for reply in self.get_replies(questions, session)]
+
+    def get_replies(self, questions, session=None):
+        """
+        批量获取答案，同时给出回答的层与耗时
 
-        # 互联网模式是否开启
+        问句按层依次处理：每一层一次处理所有尚未找到答案的问句（一次分词、一次矩阵打分等），
+        模式命令按出现的位置对其后的问句生效，因此结果与逐个调用 get_reply 相同。
+        每个问句的耗时为所在批次的总耗时的平均值
+        """
+        session = session or self.session
+        replies = list()
+        start = time.perf_counter()
+        batch = list()
+        for question in itertools.chain(questions, [None]):
+            if question is not None and question not in self.COMMANDS:
+                batch.append(question)
+                continue
+
+            results = list()
+            if batch:
+                self.refresh_corpus()
+                results = self.search_batch_cached(batch, self.get_pipeline(session))
+                results = [(answer, layer.name) if answer else (choice(self.default_answers), 'Default')
+                           for layer, answer in results]
+                batch = list()
+            if question is not None:
+                results.append(self.answer(question, session))
+
+            latency = (time.perf_counter() - start) / max(len(results), 1)
+            for answer, layer in results:
+                replies.append(Reply(answer, layer, latency))
+                self.metrics.observe_request(layer, latency)
+            start = time.perf_counter()
+        return replies
+
+    def answer(self, question, session):
+        """返回 (答案, 回答的层名)"""
+
+        # 互联网模式是否开启，只影响当前会话
         if question == 'Robot-单机模式':
-            self.INTERNET = False
-            index = len(self.pipeline) - 1
-            self.pipeline.pop(index)
-            return '联网模式关闭'
+            session.internet = False
+            return '联网模式关闭', 'Command'
 
         if question == 'Robot-联网模式':
-            self.INTERNET = True
-            self.pipeline.append(InterNet())
-            return '联网模式启动'
+            session.internet = True
+            return '联网模式启动', 'Command'
+
+        # 运行状态：各层的调用次数、命中率与耗时
+        if question == 'Robot-状态':
+            metrics, cache_stats = self.collect_metrics()
+            return metrics.summary(cache_stats), 'Command'
+
+        self.refresh_corpus()
+        layer, answer = self.search_cached(question, self.get_pipeline(session))
+        if answer:
+            return answer, layer.name
+
+        # 如果最终没有答案，则随机选择默认答案输出
+        return choice(self.default_answers), 'Default'
+
+    def search_cached(self, question, pipeline):
+        """
+        优先使用结果缓存，返回 (层, 答案)：
+
+        缓存 (层, 匹配结果) 时由该层直接生成答案；
+        缓存 None 时表示可缓存的层都没有答案，只需执行不可缓存的层（如 InterNet）；
+        回答的层之前有可缓存的层出错时不缓存，下次重新搜索
+        """
+        key = question.strip()
+        cached = self.result_cache.get(key)
+        if cached is not ResultCache.MISS:
+            if cached is None:
+                pipeline = [p for p in pipeline if not p.CACHEABLE]
+                if not pipeline:
+                    return None, None
+                layer, _, answer, _ = self.search(self.make_query(question), pipeline)
+                return layer, answer
+            layer, match = cached
+            if layer in pipeline:
+                answer = self.search_layer_match(layer, match)
+                if answer:
+                    return layer, answer
 
         # 以此经过各模块处理，如果找到答案则直接返回
-        for p in self.pipeline:
-            try:
-                answer = p.search_answer(question)
+        layer, match, answer, failed = self.search(self.make_query(question), pipeline)
+        if not failed:
+            cacheable = layer is not None and layer.CACHEABLE
+            self.result_cache.set(key, (layer, match) if cacheable else None)
+        return layer, answer
+
+    def search_batch_cached(self, questions, pipeline):
+        """
+        批量的 search_cached，返回各问句的 (层, 答案)
+
+        相同的问句只解析一次，但各自生成答案（随机选择的答案与逐个调用时一样各自选择）
+        """
+        keys = [question.strip() for question in questions]
+        found = dict()
+        full, partial = list(), list()
+        for question, key in zip(questions, keys):
+            if key in found:
+                continue
+            found[key] = (None, None, None)
+            cached = self.result_cache.get(key)
+            if cached is ResultCache.MISS:
+                full.append(question)
+            elif cached is None:
+                partial.append(question)
+            else:
+                layer, match = cached
+                answer = self.search_layer_match(layer, match) if layer in pipeline else None
                 if answer:
-                    return answer
-            except Exception as e:
-                print(e)
+                    found[key] = (layer, match, answer)
+                else:
+                    full.append(question)
 
-        # 如果最终没有答案，则随机选择默认答案输出
-        return choice(self.default_answers)
+        # 缓存为 None 的问句只需执行不可缓存的层
+        pipeline_rest = [p for p in pipeline if not p.CACHEABLE]
+        if pipeline_rest:
+            queries = [self.make_query(q) for q in partial]
+            for question, (layer, match, answer, _) in zip(partial, self.search_batch(queries, pipeline_rest)):
+                found[question.strip()] = (layer, match, answer)
+
+        queries = [self.make_query(q) for q in full]
+        for question, (layer, match, answer, failed) in zip(full, self.search_batch(queries, pipeline)):
+            key = question.strip()
+            found[key] = (layer, match, answer)
+            if not failed:
+                cacheable = layer is not None and layer.CACHEABLE
+                self.result_cache.set(key, (layer, match) if cacheable else None)
+
+        answers = list()
+        rendered = set()
+        for key in keys:
+            layer, match, answer = found[key]
+            if key in rendered and layer is not None and layer.CACHEABLE:
+                answer = self.search_layer_match(layer, match)
+            rendered.add(key)
+            answers.append((layer, answer))
+        return answers
+
+    def search_batch(self, queries, pipeline):
+        """
+        各层依次处理所有尚未找到答案的问句，返回各问句的 (层, 匹配结果, 答案, 是否出错)，
+        没有答案时前三项均为 None；是否出错同 search
+        """
+        results = [(None, None, None)] * len(queries)
+        failed = [False] * len(queries)
+        pending = list(range(len(queries)))
+        for p in pipeline:
+            if not pending:
+                break
+            if p.CACHEABLE:
+                searched = self.search_layer_batch(p, [queries[i] for i in pending])
+            else:
+                searched = [self.search_layer(p, queries[i]) for i in pending]
+            for i, (match, answer, error) in zip(pending, searched):
+                if answer:
+                    results[i] = (p, match, answer)
+                elif error and p.CACHEABLE:
+                    failed[i] = True
+            pending = [i for i in pending if results[i][0] is None]
+        return [result + (error,) for result, error in zip(results, failed)]
+
+    def search_layer_batch(self, layer, queries):
+        """
+        在一层中批量解析问句，返回各问句的 (匹配结果, 答案, 是否出错)
+
+        批量解析出错时逐个搜索，出错的问句视为没有答案
+        """
+        start = time.perf_counter()
+        try:
+            layer.ensure_loaded()
+            matches = layer.resolve_batch(queries)
+        except Exception:
+            logging.getLogger().exception(f'{layer.name} failed to resolve a batch of {len(queries)}')
+            return [self.search_layer(layer, q) for q in queries]
+
+        results = list()
+        for match in matches:
+            answer, error = None, False
+            if match is not None:
+                try:
+                    answer = layer.render(match)
+                except Exception:
+                    logging.getLogger().exception(f'{layer.name} failed to render: {match!r}')
+                    error = True
+            results.append((match, answer, error))
+
+        # 批量的耗时平均计入每个问句
+        seconds = (time.perf_counter() - start) / max(len(queries), 1)
+        for match, answer, error in results:
+            layer.observe(seconds, bool(answer), error=error)
+        return results
+
+    def search(self, query, pipeline):
+        """
+        返回 (层, 匹配结果, 答案, 是否出错)，没有答案时前三项均为 None
+
+        是否出错：回答的层（没有答案时为所有层）之前是否有可缓存的层出错，
+        出错的层可能本该给出答案，此时的结果不能缓存
+        """
+        if self.executor:
+            return self.search_concurrently(query, pipeline)
+        return self.search_in_order(query, pipeline)
+
+    @staticmethod
+    def search_layer(layer, query):
+        """在一层中搜索答案，返回 (匹配结果, 答案, 是否出错)，出错时记录日志并视为没有答案"""
+        start = time.perf_counter()
+        match, answer = None, None
+        try:
+            layer.ensure_loaded()
+            if not layer.CACHEABLE:
+                answer = layer.search_answer(query)
+            else:
+                match = layer.resolve(query)
+                if match is not None:
+                    answer = layer.render(match)
+        except Exception:
+            logging.getLogger().exception(f'{layer.name} failed: {query!r}')
+            layer.observe(time.perf_counter() - start, False, error=True)
+            return None, None, True
+        layer.observe(time.perf_counter() - start, bool(answer))
+        return match, answer, False
+
+    @staticmethod
+    def search_layer_match(layer, match):
+        """由缓存的匹配结果生成答案，出错时记录日志并视为没有答案"""
+        try:
+            return layer.ensure_loaded().render(match)
+        except Exception:
+            logging.getLogger().exception(f'{layer.name} failed to render: {match!r}')
+            return None
+
+    def search_in_order(self, query, pipeline):
+        """各层依次执行，返回第一个找到的答案"""
+        failed = False
+        for p in pipeline:
+            match, answer, error = self.search_layer(p, query)
+            if answer:
+                return p, match, answer, failed
+            failed = failed or (error and p.CACHEABLE)
+        return None, None, None, failed
+
+    def search_concurrently(self, query, pipeline):
+        """
+        本地的层（可缓存的层）同时开始执行，仍按层的先后顺序确定答案：
+
+        只有在更靠前的层都没有答案时，才采用后面的层的答案，与依次执行的结果一致。
+        不可缓存的层（如 InterNet）耗时以秒计，不提前执行、也不占用线程池，
+        更靠前的层都没有答案时才在当前线程中执行
+        """
+        futures = [self.executor.submit(self.search_layer, p, query) if p.CACHEABLE else None for p in pipeline]
+        failed = False
+        try:
+            for p, future in zip(pipeline, futures):
+                if future is None:
+                    match, answer, error = self.search_layer(p, query)
+                else:
+                    match, answer, error = future.result()
+                if answer:
+                    return p, match, answer, failed
+                failed = failed or (error and p.CACHEABLE)
+        finally:
+            # 答案已经确定，取消尚未开始的层，正在执行的层的结果直接忽略
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+        return None, None, None, failed
+
+    def cache_stats(self):
+        """结果缓存的命中统计"""
+        return self.result_cache.stats()
+
+    def metrics_snapshot(self):
+        """本进程的运行指标与结果缓存统计的快照"""
+        return self.metrics.to_dict(self.cache_stats())
+
+    def collect_metrics(self):
+        """返回 (运行指标, 结果缓存统计)，多进程服务时合并所有工作进程的"""
+        if self.worker_metrics is None:
+            return self.metrics, self.cache_stats()
+        return self.worker_metrics.collect(self.metrics_snapshot())
+
+    def metrics_text(self):
+        """Prometheus 文本格式的运行指标"""
+        metrics, cache_stats = self.collect_metrics()
+        return metrics.to_text(cache_stats)
@@ -0,0 +1,374 @@
+"""
+    知识图谱的二进制存储
+
+    --> 结点：每种实体的名称存放为一棵扁平数组表示的字典树（NameTrie），实体序号即名称的字典序，
+        名称与序号双向查找，某一前缀的所有名称对应一段连续的序号
+
+    --> 边：每种关系以 CSR 格式存放，offsets[i]:offsets[i+1] 为序号 i 的实体指向的邻居序号
+
+    --> 位图：指向指定实体（如疾病）的关系，额外为每个实体保存一行按位压缩的邻居位图，
+        多条件查询化为位图的按位与、或运算
+
+    --> 加载：以内存映射的方式读取，数组直接建立在映射的内存上，无需解析 json
+
+    文件格式：
+        magic (8 bytes) | header 长度 (uint32) | header (json) | 按 8 字节对齐的各数组
+
+"""
+
+from bisect import bisect_left
+import struct
+import mmap
+import json
+
+import numpy as np
+
+from atomic_file import atomic_write
+
+MAGIC = b'KGSTORE1'
+
+ALIGN = 8
+
+
+class NameTrie:
+    """
+    实体名称的字典树，只读
+
+        名称按字典序编号（0 ~ n-1），按深度优先的顺序即为序号的顺序，因此：
+        每个结点的子树中的名称序号是连续的一段 [lo, hi)，前缀查询只需找到前缀对应的结点；
+        结点 k 为某个名称的结尾时，该名称的序号即为 lo[k]（前缀在字典序中排在其延伸之前）
+
+        结点按广度优先编号，结点 k 的子结点为 offsets[k] ~ offsets[k+1] - 1，按字符升序排列；
+        chars[k] 为进入结点 k 的字符，parents[k] 为父结点，nodes[i] 为序号 i 的名称的结尾结点
+
+        数组均为 memoryview，逐个读取时直接得到 int，不创建 numpy 标量
+    """
+
+    def __init__(self, offsets, chars, parents, lo, hi, nodes):
+        self.offsets = offsets
+        self.chars = chars
+        self.parents = parents
+        self.lo = lo
+        self.hi = hi
+        self.nodes = nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def find(self, text):
+        """text 对应的结点，不存在时返回 None"""
+        offsets, chars = self.offsets, self.chars
+        node = 0
+        for ch in text:
+            code = ord(ch)
+            start, end = offsets[node], offsets[node + 1]
+            k = bisect_left(chars, code, start, end)
+            if k == end or chars[k] != code:
+                return None
+            node = k
+        return node
+
+    def is_name(self, node):
+        i = self.lo[node]
+        return i < len(self.nodes) and self.nodes[i] == node
+
+    def id(self, name):
+        """名称的序号，不存在时返回 None"""
+        node = self.find(name)
+        if node is None or not self.is_name(node):
+            return None
+        return self.lo[node]
+
+    def name(self, i):
+        """序号为 i 的名称，由结尾结点沿父结点回溯得到"""
+        chars, parents = self.chars, self.parents
+        node = self.nodes[i]
+        codes = list()
+        while node:
+            codes.append(chars[node])
+            node = parents[node]
+        return ''.join(map(chr, reversed(codes)))
+
+    def prefix_range(self, prefix):
+        """以 prefix 开头的名称的序号范围 (lo, hi)，没有时为空范围"""
+        node = self.find(prefix)
+        if node is None:
+            return 0, 0
+        return self.lo[node], self.hi[node]
+
+    def names(self, ids):
+        """
+        批量获取名称
+
+        数量较少时逐个回溯；较多时对所有名称同时回溯，字符码写入按行左对齐的矩阵，
+        再以 numpy 的 unicode 类型直接转换为字符串
+        """
+        if len(ids) < 64:
+            return [self.name(i) for i in ids]
+
+        parents = np.asarray(self.parents)
+        chars = np.asarray(self.chars)
+        start = np.asarray(self.nodes)[np.asarray(ids, dtype=np.int64)].astype(np.int64)
+
+        # 先求各名称的长度，再从最后一个字符开始依次写入
+        depth = np.zeros(len(start), dtype=np.int64)
+        node = start
+        while node.any():
+            depth += node > 0
+            node = parents[node]
+        width = max(int(depth.max()), 1)
+        codes = np.zeros((len(start), width), dtype=np.uint32)
+        rows = np.arange(len(start))
+        node = start
+        for step in range(width):
+            mask = node > 0
+            codes[rows[mask], depth[mask] - 1 - step] = chars[node[mask]]
+            node = parents[node]
+        return codes.view(np.dtype(('U', width))).ravel().tolist()
+
+    def __iter__(self):
+        """按序号的顺序遍历所有名称"""
+        return iter(self.names(range(len(self))))
+
+    @staticmethod
+    def build(names):
+        """
+        由名称构建字典树，names 须已按字典序排列且不重复，名称的序号即其位置
+
+        返回各数组 {数组名: numpy 数组}
+        """
+        # 先以字典构建，记录经过每个结点的名称序号范围
+        children, chars, parents, lo, hi = [dict()], [0], [0], [0], [len(names)]
+        nodes = list()
+        for i, name in enumerate(names):
+            node = 0
+            for ch in name:
+                nxt = children[node].get(ch)
+                if nxt is None:
+                    nxt = len(children)
+                    children[node][ch] = nxt
+                    children.append(dict())
+                    chars.append(ord(ch))
+                    parents.append(node)
+                    lo.append(i)
+                    hi.append(i)
+                hi[nxt] = i + 1
+                node = nxt
+            nodes.append(node)
+
+        # 按广度优先重新编号，使每个结点的子结点连续且按字符升序
+        order = [0]
+        for node in order:
+            order.extend(children[node][ch] for ch in sorted(children[node]))
+        new_ids = np.empty(len(order), dtype=np.int64)
+        new_ids[order] = np.arange(len(order))
+        counts = np.array([len(children[node]) for node in order], dtype=np.uint32)
+        offsets = np.ones(len(order) + 1, dtype=np.uint32)
+        np.cumsum(counts, out=offsets[1:])
+        offsets[1:] += 1
+
+        # 字符与名称序号的取值范围允许时以 uint16 保存
+        order = np.array(order, dtype=np.int64)
+        chars = np.array(chars, dtype=np.uint32)[order]
+        char_dtype = np.uint16 if not len(chars) or chars.max() < 1 << 16 else np.uint32
+        id_dtype = np.uint16 if len(names) < 1 << 16 else np.uint32
+        return {'offsets': offsets,
+                'chars': chars.astype(char_dtype),
+                'parents': new_ids[np.array(parents, dtype=np.int64)[order]].astype(np.uint32),
+                'lo': np.array(lo, dtype=id_dtype)[order],
+                'hi': np.array(hi, dtype=id_dtype)[order],
+                'nodes': new_ids[np.array(nodes, dtype=np.int64)].astype(np.uint32)}
+
+
+class GraphStore:
+    """内存映射的知识图谱，只读"""
+
+    VERSION = 3
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'Not a graph store file: {path}')
+        header_size = struct.unpack_from('<I', self._mm, len(MAGIC))[0]
+        start = len(MAGIC) + 4
+        header = json.loads(self._mm[start:start + header_size].decode('utf-8'))
+        if header.get('version') != self.VERSION:
+            raise ValueError(f"Graph store version must be {self.VERSION}, but got: {header.get('version')}")
+
+        self.entities = header['entities']
+        self.relations = header['relations']
+        self.bitmaps = header['bitmaps']
+        self._sections = header['sections']
+        self._arrays = dict()
+        self._tries = dict()
+
+    def _array(self, name):
+        """将一个数组建立在映射的内存上（不复制数据）"""
+        array = self._arrays.get(name)
+        if array is None:
+            offset, dtype, count = self._sections[name]
+            array = np.frombuffer(self._mm, dtype=dtype, count=count, offset=offset)
+            self._arrays[name] = array
+        return array
+
+    def count(self, entity):
+        """实体的数量"""
+        return self.entities[entity]
+
+    def _view(self, name):
+        """数组的 memoryview，逐个读取元素时比 numpy 数组快"""
+        array = self._array(name)
+        return memoryview(array).cast('B').cast(array.dtype.char)
+
+    def trie(self, entity):
+        """实体名称的字典树"""
+        trie = self._tries.get(entity)
+        if trie is None:
+            trie = NameTrie(*(self._view(f'trie/{entity}/{a}')
+                              for a in ('offsets', 'chars', 'parents', 'lo', 'hi', 'nodes')))
+            self._tries[entity] = trie
+        return trie
+
+    def name(self, entity, i):
+        """根据序号获取实体名称"""
+        return self.trie(entity).name(i)
+
+    def names(self, entity, ids):
+        """根据序号批量获取实体名称"""
+        return self.trie(entity).names(ids)
+
+    def name_id(self, entity, name):
+        """根据实体名称获取序号，不存在时返回 None"""
+        return self.trie(entity).id(name)
+
+    def iter_names(self, entity):
+        """按序号的顺序遍历实体的所有名称"""
+        return iter(self.trie(entity))
+
+    def complete(self, entity, prefix, limit=None):
+        """以 prefix 开头的实体名称，按字典序排列，最多 limit 个"""
+        lo, hi = self.trie(entity).prefix_range(prefix)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return self.names(entity, range(lo, hi))
+
+    def neighbors(self, relation, i):
+        """关系 relation 中，序号 i 的实体所指向的邻居序号（升序、不重复）"""
+        offsets = self._array(f'relation/{relation}/offsets')
+        neighbors = self._array(f'relation/{relation}/neighbors')
+        return neighbors[offsets[i]:offsets[i + 1]]
+
+    def degree(self, relation, i):
+        """关系 relation 中，序号 i 的实体的邻居数量"""
+        offsets = self._array(f'relation/{relation}/offsets')
+        return int(offsets[i + 1] - offsets[i])
+
+    def bitmap(self, relation, i):
+        """关系 relation 中，序号 i 的实体的邻居位图（np.packbits 格式，只读）"""
+        row_size = self.bitmaps[relation][1]
+        return self._array(f'bitmap/{relation}')[i * row_size:(i + 1) * row_size]
+
+    def bitmap_ids(self, entity, bits):
+        """将 entity 实体的位图还原为序号"""
+        return np.flatnonzero(np.unpackbits(bits, count=self.count(entity)))
+
+    def close(self):
+        self._tries.clear()
+        self._arrays.clear()
+        self._mm.close()
+
+    @classmethod
+    def build(cls, path, entity_dict, relation_dict, bitmap_entities=()):
+        """
+        由结点、边的 json 数据构建二进制文件
+
+        entity_dict = {'name': {'感冒': 0, ...}, ...}
+
+        relation_dict = {'symptom_name': {'头痛': [0, 3], ...}, ...}
+
+        bitmap_entities 中的实体作为关系终点时，为该关系额外生成位图
+
+        实体按名称的字典序重新编号，关系中的序号随之转换
+        """
+        arrays = list()
+        entities = dict()
+        name_ids = dict()
+        remaps = dict()
+        for entity, old_ids in entity_dict.items():
+            names = sorted(old_ids)
+            name_ids[entity] = dict(zip(names, range(len(names))))
+            remap = np.zeros(max(old_ids.values(), default=-1) + 1, dtype=np.int64)
+            remap[[old_ids[n] for n in names]] = np.arange(len(names))
+            remaps[entity] = remap
+            for name, array in NameTrie.build(names).items():
+                arrays.append((f'trie/{entity}/{name}', array))
+            entities[entity] = len(names)
+
+        relations = list()
+        bitmaps = dict()
+        for relation, rel in relation_dict.items():
+            e1, e2 = cls.split_relation(relation, entity_dict)
+            key_ids = name_ids[e1]
+            remap = remaps[e2]
+            lists = [()] * len(key_ids)
+            for k, v in rel.items():
+                lists[key_ids[k]] = sorted(set(remap[v].tolist()))
+            lengths = np.array([len(v) for v in lists], dtype=np.uint32)
+            offsets = np.zeros(len(lists) + 1, dtype=np.uint32)
+            np.cumsum(lengths, out=offsets[1:])
+            neighbors = np.fromiter((j for v in lists for j in v), dtype=np.uint32, count=int(offsets[-1]))
+            arrays.append((f'relation/{relation}/offsets', offsets))
+            arrays.append((f'relation/{relation}/neighbors', neighbors))
+            relations.append(relation)
+
+            if e2 in bitmap_entities:
+                dense = np.zeros((len(lists), len(entity_dict[e2])), dtype=bool)
+                dense[np.repeat(np.arange(len(lists)), lengths), neighbors] = True
+                packed = np.packbits(dense, axis=1)
+                arrays.append((f'bitmap/{relation}', packed.ravel()))
+                bitmaps[relation] = [e2, packed.shape[1]]
+
+        header = {'version': cls.VERSION, 'entities': entities, 'relations': relations, 'bitmaps': bitmaps}
+        cls._write(path, header, arrays)
+
+    @staticmethod
+    def split_relation(relation, entity_dict):
+        """将 e1_e2 形式的关系名拆分为两个实体名（实体名本身可能包含下划线）"""
+        for e1 in entity_dict:
+            if relation.startswith(e1 + '_') and relation[len(e1) + 1:] in entity_dict:
+                return e1, relation[len(e1) + 1:]
+        raise ValueError(f'Unknown relation: {relation}')
+
+    @staticmethod
+    def _write(path, header, arrays):
+        """写入 header 与各数组，数组起始位置按 ALIGN 对齐"""
+
+        # header 中的偏移量依赖 header 本身的长度，因此先预留足够的长度再计算
+        def layout(header_size):
+            sections = dict()
+            offset = len(MAGIC) + 4 + header_size
+            for name, array in arrays:
+                offset += -offset % ALIGN
+                sections[name] = [offset, array.dtype.str, int(array.size)]
+                offset += array.nbytes
+            return sections
+
+        header_size = 0
+        while True:
+            header['sections'] = layout(header_size)
+            header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+            if len(header_bytes) <= header_size:
+                break
+            header_size = len(header_bytes) + 256
+        header_bytes = header_bytes.ljust(header_size, b' ')
+
+        with atomic_write(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', header_size))
+            f.write(header_bytes)
+            for name, array in arrays:
+                f.write(b'\0' * (header['sections'][name][0] - f.tell()))
+                f.write(array.tobytes())
@@ -0,0 +1,114 @@
+"""
+    HTTP 连接池
+
+    --> 复用：按 (协议, 主机) 保存空闲的长连接（keep-alive），请求时优先复用
+
+    --> 跳转：自动跟随 3xx 跳转
+
+    --> 解压：支持 gzip 压缩的响应
+
+    多个线程可以同时使用同一个连接池
+
+"""
+
+from urllib.parse import urlsplit, urljoin
+import http.client
+import threading
+import gzip
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPPool:
+    """保持长连接的 HTTP 连接池，线程安全"""
+
+    def __init__(self, headers=None, timeout=3, max_idle=4, max_redirects=3):
+        self.headers = dict(headers or {})
+        self.headers.setdefault('Connection', 'keep-alive')
+        self.headers.setdefault('Accept-Encoding', 'gzip')
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        self._idle = dict()
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _acquire(self, key):
+        """取出一个空闲连接，没有时新建；返回 (连接, 是否为复用的连接)"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(*key), False
+
+    def _release(self, key, conn):
+        """归还连接，空闲连接过多时直接关闭"""
+        with self._lock:
+            idle = self._idle.setdefault(key, list())
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, conn, path):
+        conn.request('GET', path, headers=self.headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def _request(self, url):
+        """发送一次 GET 请求，返回 (状态码, 响应头, 响应体)"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn, reused = self._acquire(key)
+        try:
+            response, body = self._send(conn, path)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            # 复用的连接可能已被服务器关闭，换一个新连接重试一次
+            if not reused:
+                raise
+            conn = self._connect(*key)
+            try:
+                response, body = self._send(conn, path)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return response.status, response, body
+
+    def get(self, url, encoding='utf-8'):
+        """获取 url 的内容并解码为字符串，自动跟随跳转"""
+        for _ in range(self.max_redirects + 1):
+            status, response, body = self._request(url)
+            if status in REDIRECT_CODES and response.getheader('Location'):
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if status >= 400:
+                raise http.client.HTTPException(f'HTTP {status}: {url}')
+            return body.decode(encoding, errors='replace')
+        raise http.client.HTTPException(f'Too many redirects: {url}')
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
@@ -1,31 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as et
 from urllib.parse import quote_plus
-from urllib.request import Request
-from urllib import request
-from collections import Counter
+import http.client
 from random import choice
+import importlib.util
 import itertools
+import threading
 import logging
 import json
 import os
 import re
 
-from bs4 import BeautifulSoup
 import numpy as np
-import jieba
 
 from kg_index.medical.search_key_word import *
 from config.path_config import *
-from factory import WordWorker
+from factory import WordWorker, Query
+from automaton import KeywordAutomaton
+from graph_store import GraphStore
+from record_store import RecordStore
+from http_pool import HTTPPool
+from cache import AnswerCache
 
 
 class BaseLayer:
-    """基础父类"""
+    """
+    基础父类
+
+        search_answer 分为两步：resolve 解析问句得到匹配结果（模板序号、问句序号等），
+        render 由匹配结果生成答案。匹配结果可以缓存，随机选择答案等在 render 中进行
+
+        创建时不加载数据，在首次使用（ensure_loaded）时才调用 load 加载
+    """
+
+    # 匹配结果只由问句与本地数据决定时可以缓存
+    CACHEABLE = True
+
+    # 运行指标（metrics.LayerMetrics），由 LayerFilter 设置，为 None 时不记录
+    metrics = None
 
     def __init__(self, log=True):
         self.logger = logging.getLogger()
         if not log:
             self.close_log()
+        self.loaded = False
+        self._load_lock = threading.Lock()
 
     def close_log(self):
         self.logger.setLevel(logging.ERROR)
@@ -33,10 +52,81 @@ class BaseLayer:
     def print_log(self, msg):
         self.logger.warning(msg)
 
-    def search_answer(self, question):
+    @property
+    def name(self):
+        return type(self).__name__
+
+    def observe(self, seconds, answered, error=False):
+        """记录一次搜索的耗时与结果"""
+        if self.metrics is not None:
+            self.metrics.observe(seconds, answered, error)
+
+    def load(self):
+        """加载数据，由 ensure_loaded 在首次使用时调用"""
+        pass
+
+    def ensure_loaded(self):
+        """首次使用时加载数据，多个线程同时调用时只加载一次"""
+        if not self.loaded:
+            with self._load_lock:
+                if not self.loaded:
+                    self.load()
+                    self.loaded = True
+        return self
+
+    def search_answer(self, query):
+        """query 为 factory.Query，包含共享的问句分析结果"""
+        self.ensure_loaded()
+        match = self.resolve(query)
+        if match is None:
+            return None
+        return self.render(match)
+
+    def resolve(self, query):
+        """解析问句，返回匹配结果，没有匹配时返回 None"""
+        ...
+
+    def resolve_batch(self, queries):
+        """解析多个问句，结果与逐个调用 resolve 相同；可以合并计算的层重写此方法"""
+        return [self.resolve(q) for q in queries]
+
+    def render(self, match):
+        """由匹配结果生成答案"""
         ...
 
 
+class TemplateMatcher:
+    """
+    模板问句匹配器，加载时将所有问句的正则表达式编译好，匹配过程不保存任何状态
+
+        每个模板的问句合并为一个正则，按模板顺序确定优先级；
+        所有模板再以命名分组合并为一个整体正则，一次扫描即可判断是否命中。
+        整体正则命中第 k 个模板后，只需确认前 k 个模板中是否有更优先的命中，
+        因此结果与逐个模板、逐个问句匹配完全一致
+    """
+
+    def __init__(self, temp_questions):
+        self.temp_regexes = list()
+        group_patterns = list()
+        for i, questions in enumerate(temp_questions):
+            pattern = '|'.join(f'(?:{q})' for q in questions)
+            self.temp_regexes.append(re.compile(pattern))
+            group_patterns.append(f'(?P<t{i}>{pattern})')
+        self.regex = re.compile('|'.join(group_patterns))
+
+    def match(self, text):
+        """返回命中模板的序号，未命中返回 None"""
+        result = self.regex.search(text)
+        if result is None:
+            return None
+
+        k = int(result.lastgroup[1:])
+        for i in range(k):
+            if self.temp_regexes[i].search(text):
+                return i
+        return k
+
+
 class Template(BaseLayer):
     """
         针对机器人的人格信息，根据输入语句，利用正则表达式匹配问句，
@@ -45,11 +135,13 @@ class Template(BaseLayer):
 
     """
 
-    def __init__(self):
-        super(Template, self).__init__()
+    def load(self):
         self.template = self.load_temp_file()
         self.robot_info = self.load_robot_info()
         self.temps = self.template.findall('temp')
+        self.temp_ids = [temp.get('id') for temp in self.temps]
+        self.matcher = self.compile_questions()
+        self.answers = self.render_answers()
         self.default_answer = self.get_default('default')
         self.exceed_answer = self.get_default('exceed')
         self.print_log('Template layer is ready.')
@@ -68,122 +160,136 @@ class Template(BaseLayer):
         root = et.parse(SELF_TEMP_FILE)
         return root
 
+    def compile_questions(self):
+        """将各模板的问句编译为匹配器"""
+        temp_questions = list()
+        for temp in self.temps:
+            qs = temp.find('question').findall('q')
+            temp_questions.append([q.text for q in qs])
+        return TemplateMatcher(temp_questions)
+
+    def render_answers(self):
+        """预先将机器人信息填入各模板的答案"""
+        answers = list()
+        for temp in self.temps:
+            a_s = temp.find('answer').findall('a')
+            answers.append([a.text.format(**self.robot_info) for a in a_s])
+        return answers
+
     def get_default(self, item):
         """获取默认回复答案"""
         return self.template.find(item)
 
-    def search_answer(self, question):
-        """在模板中匹配答案"""
-        global match_temp
-        match_temp = None
-        flag = False
-        for temp in self.temps:
+    def resolve(self, query):
+        """在模板中匹配问句，返回模板序号"""
+        return self.matcher.match(query.normal)
 
-            # 搜索匹配的相关答案
-            qs = temp.find('question').findall('q')
-            for q in qs:
-                result = re.search(q.text, question)
-                if result:
-                    match_temp = temp
-                    # 匹配到后更改 标记
-                    flag = True
-                    break
-            if flag:
-                # 如果已经找打答案则跳出循环
-                break
-
-        if match_temp:
-            a_s = match_temp.find('answer').findall('a')
-            answer = choice(a_s).text
-            return answer.format(**self.robot_info)
-        else:
-            return None
+    def render(self, index):
+        return choice(self.answers[index])
 
 
 class CorpusSearch(BaseLayer):
     THRESHOLD = 0.7
 
-    def __init__(self):
-        super(CorpusSearch, self).__init__()
-        ww = WordWorker()
-        self.inverse = ww.inverse
-        self.question_list = ww.question_list
-        self.answer_list = ww.answer_list
+    def load(self):
+        self.reload()
         self.print_log('CorpusSearch layer is ready.')
 
-    @staticmethod
-    def cosine_sim(a, b):
-        """计算两个句子的 余弦相似度"""
-        a_words = Counter(a)
-        b_words = Counter(b)
-
-        # 建立两个句子的 字典 vocabulary
-        all_words = b_words.copy()
-        all_words.update(a_words - b_words)
-        all_words = set(all_words)
-
-        # 生成句子向量
-        a_vec, b_vec = list(), list()
-        for w in all_words:
-            a_vec.append(a_words.get(w, 0))
-            b_vec.append(b_words.get(w, 0))
-
-        # 计算余弦相似度值
-        a_vec = np.array(a_vec)
-        b_vec = np.array(b_vec)
-        a__ = np.sqrt(np.sum(np.square(a_vec)))
-        b__ = np.sqrt(np.sum(np.square(b_vec)))
-        cos_sim = np.dot(a_vec, b_vec) / (a__ * b__)
-
-        return round(cos_sim, 4)
-
-    def search_answer(self, question):
-        # 分词后，各词都出现在了哪些文档中
-        search_list = list()
-        q_words = jieba.lcut(question)
-        for q_word in q_words:
-            index = self.inverse.get(q_word, list())
-            search_list += index
-
-        if not search_list:
+    def reload(self):
+        """加载字典与 tf-idf 矩阵，语料库追加问答后调用"""
+        self.vocab = WordWorker.get_vocab()
+        self.corpus_index = WordWorker.get_matrix()
+
+    def search_candidates(self, query, k=3):
+        """以 tf-idf 余弦相似度对所有问句打分，返回相似度高于阈值的前 k 个 [(序号, 相似度)]"""
+
+        # 问句中各词在字典中的序号，计算一次后保存在 query 中
+        word_ids = query.word_ids
+        if word_ids is None:
+            word_ids = [self.vocab[w] for w in query.words if w in self.vocab]
+            query.word_ids = word_ids
+        unknown = len(query.words) - len(word_ids)
+
+        result = self.corpus_index.search(word_ids, unknown, k)
+        return [(i, sim) for i, sim in result if sim > self.THRESHOLD]
+
+    def resolve(self, query):
+        # 选出最相似的问句序号，如果相似度均低于阈值，则返回 None
+        result = self.search_candidates(query, k=1)
+        if result:
+            return result[0][0]
+        else:
             return None
 
-        # 统计包含问句中词汇次数最多的 3 个文档
-        count_list = Counter(search_list)
-        count_list = count_list.most_common(3)
-        result_sim = list()
-        for i, _ in count_list:
-            q = self.question_list[i]
-            sim = self.cosine_sim(q_words, q)
-            result_sim.append((i, sim))
-
-        # 根据两两的余弦相似度选出最相似的问句
-        result = max(result_sim, key=lambda x: x[1])
-
-        # 如果相似度低于阈值，则返回 None
-        if result[1] > self.THRESHOLD:
-            answer = ''.join(self.answer_list[result[0]])
-            return answer
+    def resolve_batch(self, queries):
+        """所有问句一次分词，并以一次稀疏矩阵乘法对所有问句打分"""
+        Query.segment(queries)
+        word_ids_list, unknowns = list(), list()
+        for query in queries:
+            if query.word_ids is None:
+                query.word_ids = [self.vocab[w] for w in query.words if w in self.vocab]
+            word_ids_list.append(query.word_ids)
+            unknowns.append(len(query.words) - len(query.word_ids))
+
+        results = self.corpus_index.search_batch(word_ids_list, unknowns, k=1)
+        return [result[0][0] if result and result[0][1] > self.THRESHOLD else None for result in results]
+
+    def render(self, i):
+        return self.corpus_index.answer(i)
+
+
+class SemanticSearch(BaseLayer):
+    """
+    利用 word2vec 句向量检索语料库，补充没有相同词汇、但意思相近的问句
+
+    句向量之间的相似度普遍高于 TF-IDF，只由几个虚词组成的句向量也很接近，
+    因此使用单独、更高的阈值（按 chat_log.txt 的回放结果选取）
+    """
+
+    THRESHOLD = 0.84
+
+    def load(self):
+        self.semantic_index = WordWorker.get_sentence_vectors()
+        self.reload()
+        self.print_log('SemanticSearch layer is ready.')
+
+    def reload(self):
+        """加载答案，语料库追加问答后调用（原有问句的序号不变，句向量仍然有效）"""
+        self.corpus_index = WordWorker.get_matrix()
+
+    def resolve(self, query):
+        result = self.semantic_index.search(query.words, k=1)
+        if result and result[0][1] > self.THRESHOLD:
+            return result[0][0]
         else:
             return None
 
+    def render(self, i):
+        return self.corpus_index.answer(i)
+
 
 class MedicalSearch(BaseLayer):
     """
     医疗图形数据库
     """
 
-    def __init__(self, data_path, entities, main_index):
+    # 知识图谱的构建版本，修改构建逻辑时递增，使已有结点、边文件失效
+    BUILD_VERSION = 1
+
+    def __init__(self, data_path, entities, main_index, load=True):
         super(MedicalSearch, self).__init__()
         self.__make_dirs()
         self.data_path = data_path
         self.entities = entities
         self.main_index = main_index
-        self.entity_dict = self.load_node()
-        self.relation_dict = self.load_edge()
-        self.data_index = self.load_index_data()
         self.region_key_words = key_word_dict
-        self.print_log('MedicalSearch layer is ready.')
+        self.region_labels = {f'region:{r}': r for r in self.region_key_words}
+        self.region_priority = {r: i for i, r in enumerate(self.region_key_words)}
+        self.entity_labels = {f'entity:{e}': e for e in self.entities}
+
+        # load 为 False 时只创建对象，首次使用时再加载（可以先完成构建）
+        if load:
+            self.ensure_loaded()
 
     @staticmethod
     def __make_dirs():
@@ -327,6 +433,16 @@ class MedicalSearch(BaseLayer):
         self.print_log('------')
         self.build_edge(self.data_path, self.entities)
 
+    def graph_files(self):
+        """构建知识图谱时生成的所有结点、边文件"""
+        files = list()
+        for entity in self.entities:
+            files.append(f'{MEDICAL_ENTITY_BASE_PATH}{entity}.json')
+            files.append(f'{MEDICAL_ENTITY_BASE_PATH}{entity}_inv.json')
+        for e1, e2 in itertools.permutations(self.entities, 2):
+            files.append(f'{MEDICAL_RELATION_INDEX_PATH}{e1}_{e2}.json')
+        return files
+
     @staticmethod
     def load_node():
         """加载所有结点，从保存实体的文件中读取"""
@@ -351,27 +467,70 @@ class MedicalSearch(BaseLayer):
                 relation_dict[entity_name] = json.load(file)
         return relation_dict
 
-    def load_index_data(self):
-        """加载以 main_index 为索引的所有数据"""
-        return self.__read(MEDICAL_ORIGIN_INDEX_PATH)
+    def build_store(self):
+        """将结点、边的 json 文件转换为内存映射的二进制文件"""
+        self.print_log('Start building Graph_Store...')
+        nodes = self.load_node()
+        relations = self.load_edge()
+        entity_dict = {e: nodes[e] for e in self.entities}
+        relation_dict = {f'{e1}_{e2}': relations[f'{e1}_{e2}']
+                         for e1, e2 in itertools.permutations(self.entities, 2)}
+        GraphStore.build(MEDICAL_GRAPH_PATH, entity_dict, relation_dict, bitmap_entities=[self.main_index])
+        self.print_log(f'Graph_Store built successfully. --- {MEDICAL_GRAPH_PATH}')
+
+    def load(self):
+        self.reload()
+
+    def reload(self):
+        """加载知识图谱、实体名称、原始数据以及关键词自动机，重新构建后也需调用"""
+        self.graph = GraphStore(MEDICAL_GRAPH_PATH)
+        self.records = self.load_records()
+        self.automaton = self.build_automaton()
+        self.print_log('MedicalSearch layer is ready.')
 
-    @staticmethod
-    def __unfold_and_select(data, select):
+    def build_automaton(self):
+        """以所有领域关键词与实体名称构建一个关键词自动机"""
+        automaton = KeywordAutomaton(list(self.region_labels) + list(self.entity_labels))
+        for label, region in self.region_labels.items():
+            for v in self.region_key_words[region]:
+                automaton.add(v, label)
+        for label, entity in self.entity_labels.items():
+            for name in self.graph.iter_names(entity):
+                automaton.add(name, label)
+        return automaton.build()
+
+    def build_records(self):
+        """将以 main_index 为索引的原始数据构建为记录库"""
+        self.print_log('Start building Record_Store...')
+        RecordStore.build(MEDICAL_RECORDS_PATH, self.__read(self.data_path))
+        self.print_log(f'Record_Store built successfully. --- {MEDICAL_RECORDS_PATH}')
+
+    def load_records(self):
+        """打开以 main_index 为索引的记录库，不存在时只能给出可能的疾病列表，无法给出详细信息"""
+        try:
+            return RecordStore(MEDICAL_RECORDS_PATH)
+        except FileNotFoundError as e:
+            self.print_log(f'{e}, answers of a single disease are disabled.')
+            return None
+
+    def __unfold_and_select(self, relation, item, select):
         """
-        以组合的方式展开 {key: [a, b]} 形式的数据
-        并对数据以 select 进行过滤
+        在关系 relation 中展开 select 中各实体指向的邻居位图
+        并对各位图按位取交集，邻居最少的先参与运算，交集为空时提前结束
         """
-        index_entity = set()
+        if not select:
+            return None
+
+        ids = sorted((self.graph.name_id(item, s) for s in select), key=lambda i: self.graph.degree(relation, i))
 
         # 一个问题领域，包含多个条件取交集
-        for i, s in enumerate(select):
-            item_set = set(data[s])
-            if i == 0:
-                index_entity = item_set
-            else:
-                index_entity &= item_set
+        index_bits = self.graph.bitmap(relation, ids[0]).copy()
+        for i in ids[1:]:
+            np.bitwise_and(index_bits, self.graph.bitmap(relation, i), out=index_bits)
+            if not index_bits.any():
+                break
 
-        return index_entity
+        return index_bits
 
     def search_by_entity(self, condition):
         """
@@ -382,65 +541,81 @@ class MedicalSearch(BaseLayer):
 
         """
 
-        index_set = set()
-        for i, item in enumerate(condition):
+        # 各条件的位图依次取交集，与原有逻辑一致：结果为空的条件不参与运算
+        index_bits = None
+        for item in condition:
             # 如果已经指定 main_index 则无需搜索
             if item == self.main_index:
                 continue
             else:
                 # 根据 condition 搜索其对应的 main_index
-                rel = self.relation_dict[f'{item}_{self.main_index}']
+                relation = f'{item}_{self.main_index}'
 
-            index_entity_item = self.__unfold_and_select(rel, condition[item])
-            if index_set and index_entity_item:
-                index_set &= index_entity_item
-            elif not index_set and index_entity_item:
-                index_set = index_entity_item
-            else:
+            item_bits = self.__unfold_and_select(relation, item, condition[item])
+            if item_bits is None or not item_bits.any():
                 continue
+            if index_bits is not None and index_bits.any():
+                np.bitwise_and(index_bits, item_bits, out=index_bits)
+            else:
+                index_bits = item_bits
 
-        # 将搜索到的 main_index 通过倒排索引获得对应的名称
-        result = list()
-        k = self.main_index + '_inv'
-        main_index_inv = self.entity_dict[k]
-        for i in index_set:
-            result.append(main_index_inv[str(i)])
-
-        # 如果指定了 main_index 则与搜索结果取交集
+        # 如果指定了 main_index 则与搜索结果取并集
+        index_ids = set()
+        if index_bits is not None:
+            index_ids.update(self.graph.bitmap_ids(self.main_index, index_bits).tolist())
         if condition[self.main_index]:
-            result = list(set(result) | set(condition[self.main_index]))
+            index_ids.update(self.graph.name_id(self.main_index, n) for n in condition[self.main_index])
 
-        return result
+        # 将搜索到的 main_index 序号通过字典树获得对应的名称（序号即名称的字典序）
+        return self.graph.names(self.main_index, sorted(index_ids))
 
-    def parse_question(self, question):
-        """解析问句，获取问句所询问的领域（实体），并提取出各领域的搜索值"""
+    def complete(self, prefix, limit=10):
+        """补全不完整的疾病名称，返回以 prefix 开头的 main_index 名称，按字典序最多 limit 个"""
+        self.ensure_loaded()
+        return self.graph.complete(self.main_index, prefix.strip(), limit)
 
-        # 通过领域关键词确定问题所问领域
-        region = self.main_index
-        for region_name, values in self.region_key_words.items():
-            for v in values:
-                if v in question:
-                    region = region_name
+    def extract_entities(self, question):
+        """
+        从问句中确定各实体的搜索值
 
+        实体名称重叠时按最长匹配选取，不依赖分词结果；
+        同一名称属于多种实体时，分别作为各实体的搜索值
+        """
         extract_item = dict.fromkeys(self.entities)
         for k in extract_item:
             extract_item[k] = list()
 
-        # 从实体中确定搜索值
-        jieba.load_userdict(MEDICAL_SPECIAL_WORDS_PATH)
-        q_words = jieba.lcut(question)
-        for entity in self.entities:
-            for q_word in q_words:
-                if q_word in self.entity_dict[entity]:
-                    extract_item[entity].append(q_word)
+        for hit in self.automaton.find_longest(question, self.entity_labels):
+            for label in hit.labels:
+                extract_item[self.entity_labels[label]].append(hit.word)
+
+        return extract_item
+
+    def parse_question(self, query):
+        """解析问句，获取问句所询问的领域（实体），并提取出各领域的搜索值"""
+
+        # 通过领域关键词确定问题所问领域，命中多个领域时，key_word_dict 中靠后的优先
+        region = self.main_index
+        priority = -1
+        for hit in self.automaton.find_all(query.normal, self.region_labels):
+            for label in hit.labels:
+                region_name = self.region_labels[label]
+                if self.region_priority[region_name] > priority:
+                    region, priority = region_name, self.region_priority[region_name]
 
-        return region, extract_item
+        # 从实体中确定搜索值，提取一次后保存在 query 中
+        if query.entities is None:
+            query.entities = self.extract_entities(query.normal)
+
+        return region, query.entities
 
     def format_answer(self, name, region):
         """格式化答案"""
 
-        # 根据实体名称获取该实体的相关属性、关系
-        entity = self.data_index[name]
+        # 根据实体名称从记录库中获取该实体的相关属性、关系
+        entity = self.records.get(name) if self.records is not None else None
+        if entity is None:
+            return None
         name = entity.get(self.main_index)
 
         # 获取各属性值并处理成字符串
@@ -496,23 +671,40 @@ class MedicalSearch(BaseLayer):
             answer = None
         return answer
 
-    def search_answer(self, question):
-        """搜索答案"""
+    def resolve(self, query):
+        """搜索问句对应的 main_index，返回 (名称, 领域)"""
 
-        region, extract_item = self.parse_question(question)
+        region, extract_item = self.parse_question(query)
         name_result = self.search_by_entity(extract_item)
         if name_result:
-            # 如果结果中只包含一个 main_index 则输出其详细信息
-            if len(name_result) == 1:
-                name = name_result[0]
-                answer = self.format_answer(name, region)
-            # 如果结果中包含多个，则返回列表，等待输入确定的 main_index
-            else:
-                name_list = '、'.join(name_result)
-                answer = f'根据描述，您可能的疾病为（输入疾病名称可查看其详细信息）：\n{name_list}'
-            return answer
+            return tuple(name_result), region
         return None
 
+    def resolve_batch(self, queries):
+        """提取出的实体条件相同的问句只在知识图谱中搜索一次"""
+        parsed = [self.parse_question(q) for q in queries]
+        names = dict()
+        matches = list()
+        for region, extract_item in parsed:
+            key = tuple((k, tuple(v)) for k, v in extract_item.items())
+            if key not in names:
+                names[key] = self.search_by_entity(extract_item)
+            name_result = names[key]
+            matches.append((tuple(name_result), region) if name_result else None)
+        return matches
+
+    def render(self, match):
+        name_result, region = match
+        # 如果结果中只包含一个 main_index 则输出其详细信息
+        if len(name_result) == 1:
+            name = name_result[0]
+            answer = self.format_answer(name, region)
+        # 如果结果中包含多个，则返回列表，等待输入确定的 main_index
+        else:
+            name_list = '、'.join(name_result)
+            answer = f'根据描述，您可能的疾病为（输入疾病名称可查看其详细信息）：\n{name_list}'
+        return answer
+
 
 class Generate(BaseLayer):
     """
@@ -533,6 +725,9 @@ class InterNet(BaseLayer):
     利用 Sogou 问问的接口获取问答语料库
     """
 
+    # 网上的答案随时变化，由 AnswerCache 按时间缓存
+    CACHEABLE = False
+
     DOMAIN = 'https://www.sogou.com/'
 
     # 搜索问题的链接
@@ -545,18 +740,35 @@ class InterNet(BaseLayer):
                              "AppleWebKit/600.5.17 (KHTML, like Gecko) "
                              "Version/8.0.5 Safari/600.5.17"}
 
-    def __init__(self):
+    # 从搜索结果的前 N_ANSWERS 个有效答案中随机选择
+    N_ANSWERS = 2
+
+    # 网络错误（超时、连接断开、HTTP 错误状态码），区别于页面结构不符
+    NETWORK_ERRORS = (OSError, http.client.HTTPException)
+
+    def __init__(self, workers=4, cache=None):
         super(InterNet, self).__init__()
+        self.pool = HTTPPool(self.HEADERS, timeout=3)
+        self.cache = cache if cache is not None else AnswerCache()
+        self.executor = ThreadPoolExecutor(workers)
+        self.parser = self.get_parser()
         self.print_log('InterNet layer is ready.')
 
+    @staticmethod
+    def get_parser():
+        """优先使用更快的 lxml 解析页面，未安装时使用 html.parser"""
+        if importlib.util.find_spec('lxml') is not None:
+            return 'lxml'
+        return 'html.parser'
+
     def get_html(self, url):
         """
-        不使用代理 ip
+        不使用代理 ip，通过连接池复用长连接
         """
-        req = Request(url, headers=self.HEADERS)
-        response = request.urlopen(req, timeout=3)
-        html = response.read().decode('utf8')  # 读取后数据为 bytes，需用 utf-8 进行解码
-        html = BeautifulSoup(html, 'html.parser')
+        from bs4 import BeautifulSoup
+
+        html = self.pool.get(url)
+        html = BeautifulSoup(html, self.parser)
         return html
 
     def collect_answers(self, query):
@@ -578,45 +790,106 @@ class InterNet(BaseLayer):
         skip_url = re.findall("URL=\\\'(.+)", skip_url)[0][:-1]
         return skip_url
 
-    def extract_answer(self, answer_list):
+    def fetch_answer(self, answer):
         """
-        提取问题的最佳答案
+        获取一个搜索结果的问答页面
         将问题内容、标签、答案内容整合成一条数据
         """
 
-        new_list = list()
-        for answer in answer_list:
+        a = answer.select_one('.vrTitle a')
 
-            a = answer.select_one('.vrTitle a')
+        # 获取跳转链接
+        link = self.DOMAIN + a.attrs.get('href')
+        url = self.extract_skip_url(link)
+        html = self.get_html(url)
 
-            # 获取跳转链接
-            link = self.DOMAIN + a.attrs.get('href')
-            url = self.extract_skip_url(link)
-            html = self.get_html(url)
+        # 获取问题标题与标签
+        section = html.select('.main .section')[0]
+        title = re.sub(r'[\?？]+', '', section.select_one('#question_title span').text)
+        tag = section.select_one('.tags a').text
+
+        # 获取答案相关
+        section = html.select('.main .section')[1]
+        content = section.select_one('#bestAnswers .replay-info pre')
+        if content is None:
+            content = section.select_one('.replay-section.answer_item .replay-info pre')
+        content = content.text
+        content = re.sub(r'\s+', '', content)  # 去除空格字符，包括：\r \n \r\n \t 空格
+
+        return {'title': title, 'tag': tag, 'content': content}
+
+    def try_fetch_answer(self, answer):
+        """页面结构不符、没有答案时返回 None，网络错误照常抛出"""
+        try:
+            return self.fetch_answer(answer)
+        except self.NETWORK_ERRORS:
+            raise
+        except Exception as e:
+            self.print_log(f'InterNet answer skipped: {e}')
+            return None
 
-            # 获取问题标题与标签
-            section = html.select('.main .section')[0]
-            title = re.sub(r'[\?？]+', '', section.select_one('#question_title span').text)
-            tag = section.select_one('.tags a').text
+    def extract_answer(self, answer_list):
+        """
+        提取问题的最佳答案
 
-            # 获取答案相关
-            section = html.select('.main .section')[1]
-            content = section.select_one('#bestAnswers .replay-info pre')
-            if content is None:
-                content = section.select_one('.replay-section.answer_item .replay-info pre')
-            content = content.text
-            content = re.sub(r'\s+', '', content)  # 去除空格字符，包括：\r \n \r\n \t 空格
+        只获取需要的页面：先同时获取排名靠前的 N_ANSWERS 个结果，
+        某个结果获取失败时再补充下一个结果，凑够 N_ANSWERS 个答案后不再获取
 
-            # 构建成一条答案，并添加至答案结果列表
-            answer = {'title': title, 'tag': tag, 'content': content}
-            new_list.append(answer)
-        return choice(new_list[:2])
+        没有得到答案且有页面因网络错误获取失败时抛出该错误，
+        此时无法确定这些页面是否有答案，不应作为“没有答案”缓存
+        """
+
+        candidates = iter(answer_list)
+        running = [self.executor.submit(self.try_fetch_answer, a)
+                   for a in itertools.islice(candidates, self.N_ANSWERS)]
+        new_list = list()
+        error = None
+        try:
+            while running and len(new_list) < self.N_ANSWERS:
+                try:
+                    answer = running.pop(0).result()
+                except self.NETWORK_ERRORS as e:
+                    self.print_log(f'InterNet answer failed: {e!r}')
+                    answer, error = None, e
+                if answer:
+                    new_list.append(answer)
+                else:
+                    for a in itertools.islice(candidates, 1):
+                        running.append(self.executor.submit(self.try_fetch_answer, a))
+        finally:
+            for future in running:
+                future.cancel()
+
+        if not new_list:
+            if error is not None:
+                raise error
+            return None
+        return choice(new_list)
 
     def search_answer(self, query):
-        """搜索答案"""
+        """
+        搜索答案，优先使用缓存
 
-        answers = self.collect_answers(query)
-        answer = self.extract_answer(answers).get('content')
+        没有找到答案的结果也会缓存（较短的时间）；
+        网络错误（搜索页面或答案页面获取失败）时抛出异常，不缓存
+        """
+
+        key = self.cache.normalize(query.normal)
+        answer = self.cache.get(key)
+        if answer is not AnswerCache.MISS:
+            return answer
+        answer = self.search_online(query.normal)
+        self.cache.set(key, answer)
+        return answer
+
+    def search_online(self, question):
+        """从网上搜索答案"""
+
+        answers = self.collect_answers(question)
+        answer = self.extract_answer(answers)
+        if answer is None:
+            return None
+        answer = answer.get('content')
         answer = answer.split('。')[0].split('！')[0]
         answer = re.sub(r'["“”]', '', answer) + '。'
         return answer
@@ -0,0 +1,88 @@
+"""
+    构建产物清单
+
+    --> 记录：每个构建产物所依赖源文件的内容哈希，以及产物的构建版本
+
+    --> 判断：启动时对比哈希与版本，未变化则直接加载已有产物，只重建过期的产物
+
+"""
+
+import hashlib
+import logging
+import json
+import os
+
+from config.path_config import *
+from atomic_file import atomic_write
+
+
+class BuildManifest:
+    """构建清单，以 json 文件保存于 BUILD_MANIFEST_PATH"""
+
+    def __init__(self, path=BUILD_MANIFEST_PATH, log=True):
+        self.logger = logging.getLogger()
+        if not log:
+            self.close_log()
+        self.path = path
+        self.records = self.load()
+
+    def close_log(self):
+        self.logger.setLevel(logging.ERROR)
+
+    def print_log(self, msg):
+        self.logger.warning(msg)
+
+    def load(self):
+        """读取清单，不存在或已损坏时视为空清单"""
+        if not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            self.print_log(f'Build manifest is broken, ignored: {self.path}')
+            return dict()
+
+    def save(self):
+        with atomic_write(self.path) as f:
+            json.dump(self.records, f, ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def file_hash(file_path, chunk_size=1 << 20):
+        """计算文件内容的 sha1 值"""
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def is_stale(self, name, version, sources, outputs):
+        """
+        判断产物是否需要重建
+
+        以下情况需要重建：产物文件缺失、构建版本变化、任一源文件内容变化
+        如果源文件缺失但产物齐全，则无法重建，继续使用已有产物
+        """
+        if not all(os.path.exists(p) for p in outputs):
+            return True
+
+        missing = [p for p in sources if not os.path.exists(p)]
+        if missing:
+            self.print_log(f'Sources of <{name}> are missing, use existing artifacts: {missing}')
+            return False
+
+        record = self.records.get(name)
+        if not record or record.get('version') != version:
+            return True
+
+        hashes = {p: self.file_hash(p) for p in sources}
+        return hashes != record.get('sources')
+
+    def update(self, name, version, sources, outputs):
+        """产物构建完成后，记录其源文件哈希与版本（先重新读取清单，保留其他进程的更新）"""
+        self.records = self.load()
+        self.records[name] = {'version': version,
+                              'sources': {p: self.file_hash(p) for p in sources},
+                              'outputs': list(outputs)}
+        self.save()
+        self.print_log(f'Build manifest updated: <{name}>')
@@ -0,0 +1,299 @@
+"""
+    运行指标
+
+    --> 各层：搜索次数、有答案、无答案、出错的次数，以及耗时的直方图
+
+    --> 整体：按回答的层统计的请求数，以及请求耗时的直方图
+
+    --> 输出：管理命令的文字摘要，或 Prometheus 文本格式，由 MetricsWriter 定期写入文件供本地采集
+
+    --> 多进程：各工作进程定期将可合并的快照写入同一目录，查询时合并所有工作进程的快照（WorkerMetrics）
+
+"""
+
+from bisect import bisect_left
+import threading
+import logging
+import json
+import time
+import os
+
+from config.path_config import *
+from atomic_file import atomic_write, file_lock
+
+
+class Histogram:
+    """固定分桶的耗时直方图，单位秒"""
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+    def merge(self, data):
+        """加上分桶相同的另一个直方图（to_dict 的结果）"""
+        self.counts = [a + b for a, b in zip(self.counts, data['counts'])]
+        self.sum += data['sum']
+        self.count += data['count']
+
+    def quantile(self, q):
+        """估计分位数：返回第 q 分位所在分桶的上界，超过最大分桶时返回 inf"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def lines(self, name, labels):
+        """Prometheus 文本格式的各行"""
+        lines = list()
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class LayerMetrics:
+    """一层的搜索统计"""
+
+    FIELDS = ('calls', 'hits', 'misses', 'errors')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, answered, error=False):
+        with self._lock:
+            self.calls += 1
+            if error:
+                self.errors += 1
+            elif answered:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.latency.observe(seconds)
+
+    def to_dict(self):
+        with self._lock:
+            data = {field: getattr(self, field) for field in self.FIELDS}
+            data['latency'] = self.latency.to_dict()
+            return data
+
+    def merge(self, data):
+        with self._lock:
+            for field in self.FIELDS:
+                setattr(self, field, getattr(self, field) + data[field])
+            self.latency.merge(data['latency'])
+
+
+class Metrics:
+    """LayerFilter 的运行指标"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.layers = dict()
+        self.answered = dict()
+        self.latency = Histogram()
+        self._lock = threading.Lock()
+
+    def layer(self, name):
+        """获取一层的统计，同名的层（如重新加载后）共用同一份统计"""
+        with self._lock:
+            if name not in self.layers:
+                self.layers[name] = LayerMetrics(name)
+            return self.layers[name]
+
+    def observe_request(self, layer, seconds):
+        """记录一次请求，layer 为回答的层名"""
+        with self._lock:
+            self.answered[layer] = self.answered.get(layer, 0) + 1
+            self.latency.observe(seconds)
+
+    def to_dict(self, cache_stats=None):
+        """可合并的快照（可序列化为 json），cache_stats 为结果缓存的命中统计"""
+        with self._lock:
+            layers = list(self.layers.values())
+            data = {'started': self.started, 'answered': dict(self.answered), 'latency': self.latency.to_dict()}
+        data['layers'] = {m.name: m.to_dict() for m in layers}
+        data['cache'] = cache_stats
+        return data
+
+    @classmethod
+    def merge(cls, snapshots):
+        """合并多个快照，返回 (运行指标, 结果缓存统计)；运行时间从最早的快照算起"""
+        metrics = cls()
+        cache = {'size': 0, 'hits': 0, 'misses': 0}
+        for data in snapshots:
+            metrics.started = min(metrics.started, data['started'])
+            for name, layer in data['layers'].items():
+                metrics.layer(name).merge(layer)
+            for layer, count in data['answered'].items():
+                metrics.answered[layer] = metrics.answered.get(layer, 0) + count
+            metrics.latency.merge(data['latency'])
+            for key in cache:
+                cache[key] += (data['cache'] or dict()).get(key, 0)
+        total = cache['hits'] + cache['misses']
+        cache['hit_rate'] = round(cache['hits'] / total, 4) if total else 0.0
+        return metrics, cache
+
+    def summary(self, cache_stats=None):
+        """管理命令的文字摘要"""
+        lines = [f'运行时间：{int(time.time() - self.started)} 秒，请求数：{self.latency.count}，'
+                 f'平均耗时：{self.latency.sum / max(self.latency.count, 1) * 1000:.2f} ms']
+        for m in list(self.layers.values()):
+            mean = m.latency.sum / max(m.calls, 1) * 1000
+            p95 = m.latency.quantile(0.95) * 1000
+            lines.append(f'{m.name}：调用 {m.calls}，命中 {m.hits}，未命中 {m.misses}，出错 {m.errors}，'
+                         f'平均 {mean:.2f} ms，p95 ≤ {p95:g} ms')
+        answered = '，'.join(f'{k} {v}' for k, v in sorted(self.answered.items(), key=lambda kv: -kv[1]))
+        lines.append(f'回答分布：{answered or "无"}')
+        if cache_stats:
+            lines.append(f"结果缓存：{cache_stats['size']} 条，命中率 {cache_stats['hit_rate']:.2%}")
+        return '\n'.join(lines)
+
+    def to_text(self, cache_stats=None):
+        """Prometheus 文本格式"""
+        layers = list(self.layers.values())
+        lines = list()
+        for field, help_text in (('calls', 'Layer search calls.'), ('hits', 'Layer searches with an answer.'),
+                                 ('misses', 'Layer searches without an answer.'),
+                                 ('errors', 'Layer searches that raised an exception.')):
+            lines.append(f'# HELP chatbot_layer_{field}_total {help_text}')
+            lines.append(f'# TYPE chatbot_layer_{field}_total counter')
+            for m in layers:
+                lines.append(f'chatbot_layer_{field}_total{{layer="{m.name}"}} {getattr(m, field)}')
+
+        lines.append('# HELP chatbot_layer_latency_seconds Layer search latency.')
+        lines.append('# TYPE chatbot_layer_latency_seconds histogram')
+        for m in layers:
+            lines += m.latency.lines('chatbot_layer_latency_seconds', f'layer="{m.name}"')
+
+        lines.append('# HELP chatbot_requests_total Requests by the layer that answered.')
+        lines.append('# TYPE chatbot_requests_total counter')
+        for layer, count in sorted(self.answered.items()):
+            lines.append(f'chatbot_requests_total{{layer="{layer}"}} {count}')
+
+        lines.append('# HELP chatbot_request_latency_seconds End-to-end request latency.')
+        lines.append('# TYPE chatbot_request_latency_seconds histogram')
+        lines += self.latency.lines('chatbot_request_latency_seconds', 'service="chatbot"')
+
+        if cache_stats:
+            lines.append('# TYPE chatbot_result_cache_hits_total counter')
+            lines.append(f"chatbot_result_cache_hits_total {cache_stats['hits']}")
+            lines.append('# TYPE chatbot_result_cache_misses_total counter')
+            lines.append(f"chatbot_result_cache_misses_total {cache_stats['misses']}")
+            lines.append('# TYPE chatbot_result_cache_size gauge')
+            lines.append(f"chatbot_result_cache_size {cache_stats['size']}")
+
+        lines.append('# TYPE chatbot_uptime_seconds gauge')
+        lines.append(f'chatbot_uptime_seconds {time.time() - self.started:.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsWriter:
+    """后台线程，每隔 interval 秒将 source() 返回的指标文本写入文件"""
+
+    def __init__(self, source, path=METRICS_PATH, interval=15):
+        self.source = source
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.work, name='metrics-writer', daemon=True)
+        self._thread.start()
+
+    def work(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            with atomic_write(self.path) as f:
+                f.write(self.source())
+        except Exception as e:
+            logging.getLogger().warning(f'Metrics write failed: {e}')
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+
+class WorkerMetrics:
+    """
+    多进程服务的运行指标
+
+        各工作进程的 Metrics 与结果缓存互相独立，每个工作进程每隔 interval 秒将快照写入 directory 下
+        以进程号命名的文件；查询时合并本进程的最新快照与其他工作进程的文件，其他进程的计数最多滞后 interval 秒
+
+        工作进程退出后，父进程将其快照并入 exited.json，重启工作进程后计数不会减少
+    """
+
+    EXITED = 'exited.json'
+
+    def __init__(self, directory, interval=1):
+        self.directory = directory
+        self.interval = interval
+        self.lock_path = os.path.join(directory, 'metrics.lock')
+
+    def worker_path(self, pid):
+        return os.path.join(self.directory, f'worker-{pid}.json')
+
+    def start(self, source):
+        """在工作进程中调用，source() 返回本进程的快照，由后台线程定期写入文件"""
+        return MetricsWriter(lambda: json.dumps(source()), self.worker_path(os.getpid()), self.interval)
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def collect(self, snapshot):
+        """合并本进程的快照 snapshot 与其他进程的快照，返回 (运行指标, 结果缓存统计)"""
+        own = os.path.basename(self.worker_path(os.getpid()))
+        snapshots = [snapshot]
+        with file_lock(self.lock_path):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json') and name != own:
+                    snapshots.append(self.read(os.path.join(self.directory, name)))
+        return Metrics.merge([s for s in snapshots if s])
+
+    def retire(self, pid):
+        """在父进程中调用，将已退出的工作进程 pid 的快照并入 exited.json；其结果缓存已不存在，不计入缓存大小"""
+        path = self.worker_path(pid)
+        exited = os.path.join(self.directory, self.EXITED)
+        with file_lock(self.lock_path):
+            snapshots = [s for s in (self.read(exited), self.read(path)) if s]
+            if snapshots:
+                metrics, cache = Metrics.merge(snapshots)
+                cache['size'] = 0
+                with atomic_write(exited) as f:
+                    json.dump(metrics.to_dict(cache), f)
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,82 @@
+"""
+    知识图谱的记录库
+
+    --> 构建：将原始数据（如 origin_index.json）中的每条记录序列化为 json 文本，以主键（如疾病名称）保存到 SQLite 表中
+
+    --> 读取：按主键读取单条记录，无需在内存中解析、保存全部数据；最近读取的记录保存在 LRU 缓存中
+
+    --> 多进程：以只读方式打开，每个进程（包括 fork 之后的子进程）使用各自的连接
+
+"""
+
+import threading
+import sqlite3
+import json
+import os
+
+from atomic_file import atomic_path
+from cache import ResultCache
+
+
+class RecordStore:
+    """以主键读取记录的只读记录库"""
+
+    # 文件格式的版本，修改表结构或序列化方式时递增
+    VERSION = 1
+
+    def __init__(self, path, cache_size=1024):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'Record store does not exist: {path}')
+        self.path = path
+        self.cache = ResultCache(cache_size)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        """数据库连接，fork 之后的子进程重新打开"""
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key):
+        """返回主键为 key 的记录，不存在时返回 None"""
+        record = self.cache.get(key)
+        if record is not ResultCache.MISS:
+            return record
+
+        with self._lock:
+            row = self.conn.execute('SELECT data FROM records WHERE key = ?', (key,)).fetchone()
+        record = json.loads(row[0]) if row is not None else None
+        self.cache.set(key, record)
+        return record
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @classmethod
+    def build(cls, path, records):
+        """由 {主键: 记录} 构建记录库"""
+        with atomic_path(path) as tmp_path:
+            conn = sqlite3.connect(tmp_path)
+            try:
+                conn.execute('PRAGMA journal_mode=OFF')
+                conn.execute('CREATE TABLE records (key TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID')
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                                     ((key, json.dumps(record, ensure_ascii=False))
+                                      for key, record in records.items()))
+                conn.execute('VACUUM')
+            finally:
+                conn.close()
@@ -1,7 +1,17 @@
-from chatbot import WXChatBot
+import sys
 
 if __name__ == '__main__':
-    bot = WXChatBot()
+    # python run.py [local | wechat | http]，默认为 local
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'local'
 
-    # bot.inter_start()
-    bot.local_start()
+    if mode == 'http':
+        import server
+        sys.argv = sys.argv[:1] + sys.argv[2:]
+        server.main()
+    else:
+        from chatbot import WXChatBot
+        bot = WXChatBot()
+        if mode == 'wechat':
+            bot.inter_start()
+        else:
+            bot.local_start()
@@ -0,0 +1,377 @@
+"""
+    HTTP 服务
+
+    --> 接口：
+        POST /answer          {"question": "你好", "session": "可选的会话 id"}
+        GET  /answer?question=你好&session=xxx
+        POST /answer/batch    {"questions": ["你好", ...], "session": "可选的会话 id"}
+        GET  /metrics         Prometheus 文本格式的运行指标
+        GET  /health
+
+    --> 连接：基于 asyncio，支持 HTTP/1.1 长连接（keep-alive），空闲超时后关闭
+
+    --> 并发：LayerFilter 在线程池中执行，同时处理的请求数不超过 max_concurrency，
+        等待超过 queue_timeout 秒的请求返回 503
+
+    --> 会话：联网模式等设置按会话 id 保存，请求之间不共享可变状态；未给出会话 id 时使用一次性的会话
+
+    --> 多进程：父进程加载所有层的数据后冻结垃圾回收（gc.freeze），再 fork 出多个工作进程共用同一个监听套接字，
+        只读的索引由各进程以写时复制的方式共享；工作进程退出后由父进程重新启动；
+        各工作进程定期将运行指标写入临时目录，/metrics 与 Robot-状态 返回所有工作进程合并后的指标
+
+    运行：python server.py --port 8000 [--workers 4]
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from collections import OrderedDict
+from http import HTTPStatus
+import threading
+import argparse
+import tempfile
+import asyncio
+import logging
+import shutil
+import signal
+import socket
+import json
+import time
+import gc
+import os
+
+from filter import LayerFilter, Session
+from metrics import WorkerMetrics
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None):
+        super(HTTPError, self).__init__(message or status.phrase)
+        self.status = status
+
+
+class SessionStore:
+    """按会话 id 保存会话设置，超过 max_size 时淘汰最久未使用的会话"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        if not session_id:
+            return Session()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session()
+                if len(self._sessions) > self.max_size:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            return session
+
+
+class ChatServer:
+    """LayerFilter 的 HTTP 服务"""
+
+    def __init__(self, layer_filter=None, host='127.0.0.1', port=8000, max_concurrency=8, queue_timeout=5,
+                 keep_alive_timeout=15, max_body=1 << 20, max_batch=100, max_headers=100):
+        self.logger = logging.getLogger()
+        self.layer_filter = layer_filter or LayerFilter(warm_up=True)
+        self.host = host
+        self.port = port
+        self.queue_timeout = queue_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_body = max_body
+        self.max_batch = max_batch
+        self.max_headers = max_headers
+        self.sessions = SessionStore()
+        self.executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix='answer')
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+
+    async def start(self, sock=None):
+        """开始监听，sock 为已创建的监听套接字时直接使用"""
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        if sock is not None:
+            return await asyncio.start_server(self.handle, sock=sock)
+        return await asyncio.start_server(self.handle, self.host, self.port)
+
+    async def serve_forever(self, sock=None):
+        server = await self.start(sock)
+        self.logger.warning(f"Serving on {', '.join(str(s.getsockname()) for s in server.sockets)}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """处理一个连接上的所有请求"""
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.keep_alive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+
+                try:
+                    status, content_type, payload = await self.route(method, target, body)
+                except HTTPError as e:
+                    status, content_type, payload = e.status, 'application/json', {'error': str(e)}
+                except Exception as e:
+                    self.logger.exception(e)
+                    status, content_type, payload = HTTPStatus.INTERNAL_SERVER_ERROR, 'application/json', \
+                        {'error': 'Internal Server Error'}
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                writer.write(self.make_response(status, content_type, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            writer.write(self.make_response(e.status, 'application/json', {'error': str(e)}, False))
+        except ConnectionError:
+            pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    @staticmethod
+    async def read_line(reader, status):
+        """读取一行，超过 StreamReader 的长度上限（默认 64 KiB）时以 status 回复"""
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HTTPError(status)
+
+    async def read_request(self, reader):
+        """读取一个请求，连接已关闭时返回 None；请求行或请求头过长、请求头过多时回复 414 或 431"""
+        line = await self.read_line(reader, HTTPStatus.REQUEST_URI_TOO_LONG)
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+
+        headers = dict()
+        for count in range(self.max_headers + 1):
+            line = await self.read_line(reader, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if count == self.max_headers:
+                raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+        if length < 0:
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+        if length > self.max_body:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), target, version.upper(), headers, body
+
+    @staticmethod
+    def make_response(status, content_type, payload, keep_alive):
+        if content_type == 'application/json':
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        else:
+            body = payload.encode('utf-8')
+        head = (f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                f'Content-Type: {content_type}; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        return head.encode('latin-1') + body
+
+    @staticmethod
+    def parse_params(method, target, body):
+        """GET 请求取查询参数，POST 请求取 json 正文"""
+        if method == 'GET':
+            return {k: v[0] for k, v in parse_qs(urlsplit(target).query).items()}
+        try:
+            params = json.loads(body.decode('utf-8')) if body else dict()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, 'Body must be json.')
+        if not isinstance(params, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, 'Body must be a json object.')
+        return params
+
+    async def route(self, method, target, body):
+        path = urlsplit(target).path
+        if path == '/health':
+            return HTTPStatus.OK, 'application/json', {'status': 'ok'}
+        if path == '/metrics':
+            return HTTPStatus.OK, 'text/plain', self.layer_filter.metrics_text()
+        if path not in ('/answer', '/answer/batch'):
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+        if method not in ('GET', 'POST'):
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+
+        params = self.parse_params(method, target, body)
+        session = self.sessions.get(params.get('session'))
+        if path == '/answer':
+            question = params.get('question')
+            if not isinstance(question, str):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'question' is required.")
+            reply = await self.run(self.layer_filter.get_reply, question, session)
+            return HTTPStatus.OK, 'application/json', self.reply_json(reply)
+
+        questions = params.get('questions')
+        if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'questions' must be a list of strings.")
+        if len(questions) > self.max_batch:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f'At most {self.max_batch} questions.')
+        replies = await self.run(self.layer_filter.get_replies, questions, session)
+        return HTTPStatus.OK, 'application/json', {'answers': [self.reply_json(r) for r in replies]}
+
+    async def run(self, func, *args):
+        """在线程池中执行，同时执行的数量受 semaphore 限制，等待过久时返回 503"""
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, 'Server is busy.')
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.semaphore.release()
+
+    @staticmethod
+    def reply_json(reply):
+        return {'answer': reply.text, 'layer': reply.layer, 'latency_ms': round(reply.latency * 1000, 3)}
+
+
+class PreforkServer:
+    """
+    预先 fork 的多进程服务
+
+        父进程加载所有层的数据，gc.freeze 将已有对象移出垃圾回收的跟踪范围，
+        避免子进程的垃圾回收改写这些对象所在的内存页；numpy 数组、内存映射的图谱与扁平的 array
+        不含引用计数，子进程读取时不会复制，因此每增加一个工作进程，增加的内存很少
+    """
+
+    # 工作进程启动后不足该秒数即退出时，等待后再重新启动，避免反复 fork
+    RESTART_DELAY = 1.0
+
+    def __init__(self, workers=None, host='127.0.0.1', port=8000, semantic=False, **options):
+        self.logger = logging.getLogger()
+        self.workers = workers or os.cpu_count() or 1
+        self.semantic = semantic
+        self.host = host
+        self.port = port
+        self.options = options
+        self.children = dict()
+        self.stopping = False
+        self.layer_filter = None
+        self.worker_metrics = None
+        self.sock = None
+
+    def run(self):
+        # 父进程中加载期间的临时对象较多，加载完成后统一回收再冻结
+        gc.disable()
+        self.layer_filter = LayerFilter(semantic=self.semantic)
+        self.layer_filter.warm_up_layers(self.layer_filter.pipeline)
+        self.sock = socket.create_server((self.host, self.port), backlog=1024)
+        self.sock.set_inheritable(True)
+        self.worker_metrics = WorkerMetrics(tempfile.mkdtemp(prefix='chatbot-metrics-'))
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        self.logger.warning(f'Serving on {self.sock.getsockname()} with {self.workers} workers')
+        self.supervise()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return pid
+
+        # 工作进程
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            gc.enable()
+            self.layer_filter.worker_metrics = self.worker_metrics
+            self.worker_metrics.start(self.layer_filter.metrics_snapshot)
+            server = ChatServer(self.layer_filter, **self.options)
+            asyncio.run(server.serve_forever(self.sock))
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            self.logger.exception('Worker failed')
+            code = 1
+        finally:
+            os._exit(code)
+
+    def supervise(self):
+        """等待工作进程退出，未停止服务时重新启动"""
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            self.worker_metrics.retire(pid)
+            if self.stopping:
+                continue
+            self.logger.warning(f'Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting.')
+            if time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            if not self.stopping:
+                self.spawn()
+        self.sock.close()
+        shutil.rmtree(self.worker_metrics.directory, ignore_errors=True)
+
+    def stop(self, signum=None, frame=None):
+        """停止服务：通知所有工作进程退出"""
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='问答机器人 HTTP 服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, default=8, help='每个进程同时处理的请求数')
+    parser.add_argument('--workers', type=int, default=1, help='工作进程数，为 0 时与 CPU 核数相同')
+    parser.add_argument('--semantic', action='store_true', help='启用句向量检索层')
+    args = parser.parse_args()
+
+    if args.workers != 1:
+        PreforkServer(args.workers, args.host, args.port, semantic=args.semantic,
+                      max_concurrency=args.concurrency).run()
+        return
+
+    layer_filter = LayerFilter(warm_up=True, semantic=args.semantic)
+    server = ChatServer(layer_filter, host=args.host, port=args.port, max_concurrency=args.concurrency)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+    分词器
+
+    --> 构建：将 jieba 基础词典与自定义词典、医疗专有词汇合并为前缀词典，序列化保存
+
+    --> 加载：每个进程只反序列化一次，所有模块共享同一个分词器
+
+"""
+
+import threading
+import marshal
+import logging
+import os
+
+import jieba
+
+from config.path_config import *
+from atomic_file import atomic_write
+
+jieba.setLogLevel('INFO')
+
+
+class Segmenter:
+    """共享分词器，前缀词典从 TOKENIZER_DICT_PATH 加载"""
+
+    # 前缀词典的构建版本，jieba 版本变化时同样需要重建
+    BUILD_VERSION = f'1-{jieba.__version__}'
+
+    # 合并进前缀词典的自定义词典
+    BUILD_SOURCES = [SPECIAL_WORDS_PATH, MEDICAL_SPECIAL_WORDS_PATH]
+
+    BUILD_OUTPUTS = [TOKENIZER_DICT_PATH]
+
+    def __init__(self, dict_path=TOKENIZER_DICT_PATH, rebuild=False, log=True):
+        self.logger = logging.getLogger()
+        if not log:
+            self.close_log()
+        self.dict_path = dict_path
+        self.tokenizer = jieba.Tokenizer()
+        if rebuild or not self.load():
+            self.build()
+            self.load()
+
+    def close_log(self):
+        self.logger.setLevel(logging.ERROR)
+
+    def print_log(self, msg):
+        self.logger.warning(msg)
+
+    def build(self):
+        """加载基础词典与自定义词典，并将合并后的前缀词典序列化保存"""
+        tokenizer = jieba.Tokenizer()
+        tokenizer.initialize()
+        for user_dict in self.BUILD_SOURCES:
+            tokenizer.load_userdict(user_dict)
+
+        with atomic_write(self.dict_path, 'wb') as f:
+            marshal.dump((self.BUILD_VERSION, tokenizer.FREQ, tokenizer.total), f)
+        self.print_log(f'Tokenizer dictionary is completed. --- {self.dict_path}')
+
+    def load(self):
+        """加载序列化的前缀词典，文件不存在或版本不符时返回 False"""
+        if not os.path.exists(self.dict_path):
+            return False
+        try:
+            with open(self.dict_path, 'rb') as f:
+                version, freq, total = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return False
+        if version != self.BUILD_VERSION:
+            return False
+
+        with self.tokenizer.lock:
+            self.tokenizer.FREQ, self.tokenizer.total = freq, total
+            self.tokenizer.initialized = True
+        return True
+
+    def lcut(self, sentence):
+        """精确模式分词"""
+        return self.tokenizer.lcut(sentence)
+
+    def lcut_batch(self, sentences):
+        """
+        对多个句子分词，结果与逐句调用 lcut 相同
+
+        换行符总是单独成词，不会与前后的字合并，因此将句子以换行符连接后一次分词，
+        再按换行符切分；本身包含换行符的句子单独分词
+        """
+        results = [None] * len(sentences)
+        batch = list()
+        for i, sentence in enumerate(sentences):
+            if '\n' in sentence or '\r' in sentence:
+                results[i] = self.lcut(sentence)
+            else:
+                batch.append(i)
+        if not batch:
+            return results
+
+        words = self.lcut('\n'.join(sentences[i] for i in batch))
+        start = 0
+        it = iter(batch)
+        for k, w in enumerate(words):
+            if w == '\n':
+                results[next(it)] = words[start:k]
+                start = k + 1
+        results[next(it)] = words[start:]
+        return results
+
+
+_segmenter = None
+_segmenter_lock = threading.Lock()
+
+
+def get_segmenter(rebuild=False):
+    """获取进程内共享的分词器，首次调用时加载；rebuild 为 True 时重建前缀词典"""
+    global _segmenter
+    if _segmenter is None or rebuild:
+        with _segmenter_lock:
+            if _segmenter is None:
+                _segmenter = Segmenter(rebuild=rebuild)
+            elif rebuild:
+                _segmenter.build()
+                _segmenter.load()
+    return _segmenter
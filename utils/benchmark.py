@@ -0,0 +1,203 @@
+"""
+    回放基准测试（在项目根目录下执行）
+
+    --> 回放：将聊天记录或问句文件中的问句依次交给 LayerFilter，InterNet 层替换为不联网的空层
+
+    --> 统计：启动耗时（包括加载各层的数据）、端到端与各层的 p50/p95/p99 延迟、吞吐量、各层回答的比例、峰值内存
+
+    --> 输出：结果保存为 json，可与之前的结果对比，延迟或吞吐量变差超过容差时以非零状态退出
+
+    用法（不指定问句文件时回放 config/chat_log.txt 与 config/chat_log.jsonl）：
+        python -m utils.benchmark config/chat_log.txt utils/question_to_learn.txt --repeat 3
+        python -m utils.benchmark config/chat_log.txt --baseline old.json --tolerance 0.2
+
+    支持的问句文件：
+        聊天记录 chat_log.txt（Q: 问句  ---  A: 答案）、ChatLogSink 的 jsonl 记录、每行一个问句的文本
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict
+import subprocess
+import platform
+import argparse
+import resource
+import time
+import json
+import sys
+import os
+
+import numpy as np
+
+from config.path_config import *
+from filter import LayerFilter
+from layer import BaseLayer
+
+# 默认回放的问句文件：原有的聊天记录与 ChatLogSink 写入的聊天记录（存在时）
+DEFAULT_FILES = [BASE_CONFIG + 'chat_log.txt', CHAT_LOG_PATH]
+
+
+class OfflineInterNet(BaseLayer):
+    """代替 InterNet 的不联网的层，总是没有答案；不创建连接池、线程池与答案缓存"""
+
+    CACHEABLE = False
+
+    def search_answer(self, query):
+        return None
+
+
+class TimedLayerFilter(LayerFilter):
+    """记录每一层每次搜索的耗时"""
+
+    def __init__(self, *args, **kwargs):
+        self.layer_latency = defaultdict(list)
+        super(TimedLayerFilter, self).__init__(*args, **kwargs)
+
+    def search_layer(self, layer, query):
+        start = time.perf_counter()
+        try:
+            return super(TimedLayerFilter, self).search_layer(layer, query)
+        finally:
+            self.layer_latency[type(layer).__name__].append(time.perf_counter() - start)
+
+
+def read_questions(path):
+    """读取问句文件"""
+    questions = list()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                try:
+                    question = json.loads(line).get('question')
+                except ValueError:
+                    continue
+            elif line.startswith('Q:') and '---' in line:
+                question = line.split('---')[0][2:]
+            else:
+                question = line
+            if question and question.strip():
+                questions.append(question.strip())
+    return questions
+
+
+def percentiles(seconds):
+    """延迟的分位数，单位毫秒"""
+    if not seconds:
+        return {'count': 0}
+    ms = np.array(seconds) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {'count': len(ms), 'mean': round(float(ms.mean()), 4), 'p50': round(float(p50), 4),
+            'p95': round(float(p95), 4), 'p99': round(float(p99), 4), 'max': round(float(ms.max()), 4)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(files, repeat=1, workers=1, concurrency=0, cache_size=10000, semantic=False):
+    questions = list()
+    for path in files:
+        questions += read_questions(path)
+    if not questions:
+        raise ValueError(f'No questions found in: {files}')
+
+    # 各层在首次使用时才加载，启动耗时包括提前加载各层（与服务启动时相同），否则都计入第一个问句
+    start = time.perf_counter()
+    layer_filter = TimedLayerFilter(concurrency=concurrency, cache_size=cache_size, semantic=semantic)
+    layer_filter.internet = layer_filter.attach_metrics(OfflineInterNet())
+    warm_up_start = time.perf_counter()
+    layer_filter.warm_up_layers(layer_filter.pipeline)
+    warm_up = time.perf_counter() - warm_up_start
+    startup = time.perf_counter() - start
+
+    replies = list()
+    replay = questions * repeat
+    start = time.perf_counter()
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            replies = list(executor.map(layer_filter.get_reply, replay))
+    else:
+        replies = [layer_filter.get_reply(q) for q in replay]
+    elapsed = time.perf_counter() - start
+
+    by_layer = defaultdict(list)
+    for reply in replies:
+        by_layer[reply.layer].append(reply.latency)
+    hits = Counter(reply.layer for reply in replies)
+
+    return {
+        'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'files': files, 'questions': len(questions), 'repeat': repeat, 'workers': workers,
+                 'concurrency': concurrency, 'cache_size': cache_size, 'semantic': semantic},
+        'startup_s': round(startup, 4),
+        'warm_up_s': round(warm_up, 4),
+        'elapsed_s': round(elapsed, 4),
+        'throughput_qps': round(len(replay) / elapsed, 2) if elapsed else None,
+        'end_to_end_ms': percentiles([reply.latency for reply in replies]),
+        'answered_by_ms': {layer: percentiles(latency) for layer, latency in sorted(by_layer.items())},
+        'layer_ms': {layer: percentiles(latency) for layer, latency in sorted(layer_filter.layer_latency.items())},
+        'hit_distribution': {layer: round(count / len(replies), 4) for layer, count in hits.most_common()},
+        'result_cache': layer_filter.cache_stats(),
+        # Linux 下 ru_maxrss 的单位为 KB
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """与之前的结果对比，返回变差超过容差的指标"""
+    regressions = list()
+    for key in ('p50', 'p95', 'p99'):
+        new, old = result['end_to_end_ms'].get(key), baseline['end_to_end_ms'].get(key)
+        if new is not None and old:
+            change = (new - old) / old
+            print(f'end_to_end {key}: {old} -> {new} ms ({change:+.1%})')
+            if change > tolerance:
+                regressions.append(key)
+
+    new, old = result['throughput_qps'], baseline['throughput_qps']
+    if new is not None and old:
+        change = (new - old) / old
+        print(f'throughput: {old} -> {new} qps ({change:+.1%})')
+        if -change > tolerance:
+            regressions.append('throughput')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='回放基准测试')
+    parser.add_argument('files', nargs='*', help='问句文件，默认为 chat_log.txt 与 chat_log.jsonl（存在时）')
+    parser.add_argument('--repeat', type=int, default=1, help='回放的遍数')
+    parser.add_argument('--workers', type=int, default=1, help='同时提问的线程数')
+    parser.add_argument('--concurrency', type=int, default=0, help='LayerFilter 各层并发执行的线程数')
+    parser.add_argument('--cache-size', type=int, default=10000, help='结果缓存的大小，为 0 时不缓存')
+    parser.add_argument('--semantic', action='store_true', help='启用句向量检索层')
+    parser.add_argument('--output', default='benchmark.json', help='结果文件')
+    parser.add_argument('--baseline', help='用于对比的之前的结果文件')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许变差的比例')
+    args = parser.parse_args()
+
+    files = args.files or [path for path in DEFAULT_FILES if os.path.exists(path)]
+    result = run(files, args.repeat, args.workers, args.concurrency, args.cache_size, args.semantic)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f'Regression: {regressions}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+    语料库维护命令（在项目根目录下执行）
+
+    --> 追加：python -m utils.corpus_cli append 问句 答案
+
+    --> 追加文件：python -m utils.corpus_cli append-file 文件路径（问句、答案交替成行，与语料库格式相同）
+
+    --> 从聊天记录追加：python -m utils.corpus_cli append-log config/chat_log.jsonl [--layers InterNet]
+        只追加由指定层（默认为 InterNet）回答的问答
+
+    --> 联网学习：python -m utils.corpus_cli learn utils/question_to_learn.txt
+        对每行一个的问句从网上搜索答案，找到答案的问答追加到语料库
+
+    --> 完整重建：python -m utils.corpus_cli compact
+        对整个语料库重新分词，重建字典、倒排索引与 tf-idf 矩阵（精确的 idf），适合离线定期执行
+
+    追加与重建完成后，正在运行的机器人会自动重新加载语料库
+
+"""
+
+import argparse
+import json
+
+from config.path_config import *
+from factory import WordWorker, Query
+from manifest import BuildManifest
+
+
+def update_manifest():
+    """记录新的语料库哈希，下次启动时无需重建"""
+    BuildManifest().update('corpus', WordWorker.BUILD_VERSION, WordWorker.BUILD_SOURCES, WordWorker.BUILD_OUTPUTS)
+
+
+def append(pairs):
+    count = WordWorker.append_qa(pairs)
+    if count:
+        update_manifest()
+    print(f'{count} QA pairs appended.')
+
+
+def read_pairs(path):
+    """读取问句、答案交替成行的文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return list(zip(lines[0::2], lines[1::2]))
+
+
+def read_log_pairs(path, layers):
+    """读取 ChatLogSink 写入的聊天记录中由 layers 回答的问答"""
+    pairs = list()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('layer') in layers:
+                pairs.append((record.get('question') or '', record.get('answer') or ''))
+    return pairs
+
+
+def learn_pairs(path):
+    """对文件中的问句从网上搜索答案"""
+    from layer import InterNet
+
+    internet = InterNet()
+    questions = set(WordWorker.get_questions())
+    pairs = list()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            question = line.strip()
+            if not question or question in questions:
+                continue
+            questions.add(question)
+            try:
+                answer = internet.search_answer(Query(question))
+            except Exception as e:
+                print(f'{question}: {e}')
+                continue
+            if answer:
+                pairs.append((question, answer))
+    return pairs
+
+
+def compact(processes=None):
+    WordWorker.build_index(processes)
+    update_manifest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='语料库维护')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('append', help='追加一个问答')
+    command.add_argument('question')
+    command.add_argument('answer')
+
+    command = commands.add_parser('append-file', help='追加文件中的问答（问句、答案交替成行）')
+    command.add_argument('path')
+
+    command = commands.add_parser('append-log', help='追加聊天记录中的问答')
+    command.add_argument('path', nargs='?', default=CHAT_LOG_PATH)
+    command.add_argument('--layers', nargs='+', default=['InterNet'])
+
+    command = commands.add_parser('learn', help='对问句从网上搜索答案并追加')
+    command.add_argument('path')
+
+    command = commands.add_parser('compact', help='完整重建语料库索引')
+    command.add_argument('--processes', type=int, default=None, help='分词的进程数，默认为 CPU 核数')
+
+    args = parser.parse_args()
+    if args.command == 'append':
+        append([(args.question, args.answer)])
+    elif args.command == 'append-file':
+        append(read_pairs(args.path))
+    elif args.command == 'append-log':
+        append(read_log_pairs(args.path, set(args.layers)))
+    elif args.command == 'learn':
+        append(learn_pairs(args.path))
+    elif args.command == 'compact':
+        compact(args.processes)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()